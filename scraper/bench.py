@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+MatrUSP scraper checks and benchmarks over saved JupiterWeb pages.
+
+Pages are plain HTML files named after the endpoint they came from, e.g.
+`obterTurma-MAC0110.html`, `obterDisciplina-MAC0110.html` or
+`listarGradeCurricular-45-1.html`. A directory written by
+`main.py --record` has this layout.
+
+Usage:
+    uv run --extra fast bench.py conformance pages/
+    uv run bench.py replay pages/ --baseline bench-baseline.json
+    uv run bench.py replay pages/ --save-baseline bench-baseline.json
+    uv run bench.py micro pages/
+    uv run --extra compact bench.py compact ../public/db
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import re
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+from rich.console import Console
+from rich.table import Table
+
+import main
+
+console = Console()
+
+ENDPOINTS = ("obterTurma", "obterDisciplina", "listarGradeCurricular")
+
+
+def read_page(path: Path) -> str:
+    """Decode a saved page, using its recorded headers when there are any."""
+    index = path.parent / "index.json"
+    if index.exists():
+        for entry in json.loads(index.read_text()).values():
+            if entry["file"] == path.name:
+                return httpx.Response(
+                    200, headers=entry["headers"], content=path.read_bytes()
+                ).text
+    return path.read_text()
+
+
+def load_pages(pages_dir: Path) -> list[tuple[str, Path]]:
+    """List saved pages as (endpoint, path), in a stable order."""
+    pages = []
+    for endpoint in ENDPOINTS:
+        for path in sorted(pages_dir.glob(f"{endpoint}*.html")):
+            pages.append((endpoint, path))
+    return pages
+
+
+def parse_page(endpoint: str, text: str, parser: str):
+    """Run the parser used by the scraper for this kind of page."""
+    if endpoint == "obterTurma":
+        return main.parse_turma_page(text, parser)
+    if endpoint == "obterDisciplina":
+        return main.parse_disciplina_page(text, parser, {})
+    return main.parse_course_page(text, parser, "", "", {})
+
+
+def available_parsers() -> list[str]:
+    parsers = []
+    for parser in main.PARSERS:
+        try:
+            main.parse_html("", parser)
+        except (ImportError, main.FeatureNotFound):
+            console.print(f"[yellow]Skipping {parser}: not installed[/yellow]")
+            continue
+        parsers.append(parser)
+    return parsers
+
+
+def encode(result) -> str:
+    return json.dumps(result, ensure_ascii=False, default=main.json_default)
+
+
+def conformance(pages_dir: Path) -> int:
+    """Check every backend produces byte-identical JSON for every page."""
+    pages = load_pages(pages_dir)
+    if not pages:
+        console.print(f"[red]No saved pages in {pages_dir}[/red]")
+        return 1
+
+    parsers = available_parsers()
+    if len(parsers) < 2:
+        console.print(
+            "[red]Conformance needs at least two backends (--extra fast)[/red]"
+        )
+        return 1
+    reference, *others = parsers
+    failures = 0
+
+    for endpoint, path in pages:
+        text = read_page(path)
+        expected = encode(parse_page(endpoint, text, reference))
+        for parser in others:
+            actual = encode(parse_page(endpoint, text, parser))
+            if actual != expected:
+                failures += 1
+                console.print(
+                    f"[red]{path.name}: {parser} differs from {reference}[/red]"
+                )
+
+    table = Table(title="Parser conformance")
+    table.add_column("Pages", justify="right")
+    table.add_column("Backends")
+    table.add_column("Mismatches", justify="right")
+    table.add_row(str(len(pages)), ", ".join(parsers), str(failures))
+    console.print(table)
+    return 1 if failures else 0
+
+
+# Metrics compared with the baseline; the others are only shown
+GATED = {
+    "replay_page_cost",
+    "parse_classrooms_cost",
+    "parse_course_periods_cost",
+    "peak_rss_mb",
+}
+
+
+def time_parser(pages: list[str], prepare, parse) -> float:
+    """Mean milliseconds per page of parse(prepare(page)), excluding prepare."""
+    inputs = [x for x in (prepare(text) for text in pages) if x is not None]
+    if not inputs:
+        return 0.0
+    start = time.perf_counter()
+    for x in inputs:
+        parse(x)
+    return (time.perf_counter() - start) * 1000 / len(inputs)
+
+
+def periods_table(text: str) -> main.Table | None:
+    re_obrigatorias = re.compile(r"Disciplinas\s+Obrigatórias")
+    for table in main.parse_html(text).leaf_tables():
+        if any(re_obrigatorias.search(s) for s in table.strings):
+            return table
+    return None
+
+
+def replay(
+    pages_dir: Path, latency: float, parser: str, concurrency: int, repeat: int
+) -> dict[str, float]:
+    """Run a full scrape against a recording `repeat` times and measure it.
+
+    Machine speed drifts too much between runs, and between runners, for
+    absolute times to be compared, so each round also times html5lib
+    parsing the same pages and the `*_cost` metrics are the round's times
+    relative to it (median over rounds). Only those and peak memory are
+    compared with a baseline; pages/s and milliseconds are for reading.
+    """
+    urls = json.loads((pages_dir / "index.json").read_text())
+    units = sorted(
+        {m.group(1) for url in urls if (m := re.search(r"Lista\?.*codcg=(\d+)", url))}
+    )
+    courses = any("jupCursoLista" in url for url in urls)
+
+    pages = load_pages(pages_dir)
+    turmas = [read_page(path) for endpoint, path in pages if endpoint == "obterTurma"]
+    grades = [
+        read_page(path)
+        for endpoint, path in pages
+        if endpoint == "listarGradeCurricular"
+    ]
+
+    rounds = defaultdict(list)
+    for _ in range(repeat):
+        reference = time_parser(
+            [read_page(path) for _, path in pages],
+            lambda text: text,
+            lambda text: main.parse_html(text, "html5lib"),
+        )
+
+        # Metrics accumulate over the process, so count this run's pages only
+        before = main.metrics.pages()
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as out:
+            asyncio.run(
+                main.scrape(
+                    Path(out),
+                    units,
+                    concurrency,
+                    60,
+                    main.make_transport(
+                        concurrency, 0, replay=pages_dir, replay_latency=latency
+                    ),
+                    parser,
+                    lectures=True,
+                    courses=courses,
+                )
+            )
+        page_ms = (time.perf_counter() - start) * 1000 / (main.metrics.pages() - before)
+
+        classrooms_ms = time_parser(
+            turmas,
+            lambda text: main.parse_html(text, parser).leaf_tables(),
+            main.parse_classrooms,
+        )
+        periods_ms = time_parser(grades, periods_table, main.parse_course_periods)
+
+        rounds["pages_per_s"].append(1000 / page_ms)
+        rounds["parse_classrooms_ms"].append(classrooms_ms)
+        rounds["parse_course_periods_ms"].append(periods_ms)
+        rounds["replay_page_cost"].append(page_ms / reference)
+        rounds["parse_classrooms_cost"].append(classrooms_ms / reference)
+        rounds["parse_course_periods_cost"].append(periods_ms / reference)
+
+    result = {name: statistics.median(values) for name, values in rounds.items()}
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def info_tables(text: str, parser: str) -> list[main.Table]:
+    """The classroom info tables of an obterTurma page, one per turma."""
+    return [
+        table
+        for table in main.parse_html(text, parser).leaf_tables()
+        if main.classify_classroom_table(table) == "info"
+    ]
+
+
+def micro(pages_dir: Path, parser: str, repeat: int) -> int:
+    """Time the table-level parsers per page, and per turma for obterTurma,
+    with HTML parsing excluded. Caches (format_date) are warm."""
+    pages = load_pages(pages_dir)
+    texts = {endpoint: [] for endpoint in ENDPOINTS}
+    for endpoint, path in pages:
+        texts[endpoint].append(read_page(path))
+    turmas = sum(len(info_tables(text, parser)) for text in texts["obterTurma"])
+
+    cases = [
+        (
+            "parse_classroom_info",
+            texts["obterTurma"],
+            lambda text: info_tables(text, parser),
+            lambda tables: [main.parse_classroom_info(t) for t in tables],
+        ),
+        (
+            "parse_classrooms",
+            texts["obterTurma"],
+            lambda text: main.parse_html(text, parser).leaf_tables(),
+            main.parse_classrooms,
+        ),
+        (
+            "parse_classroom_vacancies",
+            texts["obterTurma"],
+            lambda text: main.parse_html(text, parser).leaf_tables(),
+            main.parse_classroom_vacancies,
+        ),
+        (
+            "parse_lecture_info",
+            texts["obterDisciplina"],
+            lambda text: main.parse_html(text, parser).leaf_tables(),
+            lambda tables: main.parse_lecture_info(tables, {}),
+        ),
+        (
+            "parse_course",
+            texts["listarGradeCurricular"],
+            lambda text: main.parse_html(text, parser),
+            lambda doc: main.parse_course(doc, "", "", {}),
+        ),
+    ]
+
+    table = Table(title=f"Parser micro-benchmarks ({parser}, best of {repeat})")
+    table.add_column("Function")
+    table.add_column("Pages", justify="right")
+    table.add_column("µs/page", justify="right")
+    table.add_column("µs/turma", justify="right")
+    for name, inputs, prepare, parse in cases:
+        if not inputs:
+            continue
+        best = min(time_parser(inputs, prepare, parse) for _ in range(repeat))
+        per_turma = ""
+        if inputs is texts["obterTurma"] and turmas:
+            per_turma = f"{best * 1000 * len(inputs) / turmas:.1f}"
+        table.add_row(name, str(len(inputs)), f"{best * 1000:.1f}", per_turma)
+    console.print(table)
+    return 0
+
+
+def compare(metrics: dict, baseline: dict, tolerance: float) -> int:
+    """Print metrics next to the baseline; fail when a gated one is worse by
+    more than tolerance."""
+    table = Table(title="Replay benchmark")
+    table.add_column("Metric")
+    table.add_column("Baseline", justify="right")
+    table.add_column("Now", justify="right")
+    table.add_column("Change", justify="right")
+
+    regressions = 0
+    for name, value in metrics.items():
+        base = baseline.get(name)
+        if not base:
+            table.add_row(name, "-", f"{value:.4g}", "")
+            continue
+        change = (value - base) / base
+        if name in GATED:
+            # Every gated metric is better when smaller
+            style = "red" if change > tolerance else "green"
+            regressions += change > tolerance
+            shown = f"[{style}]{change:+.0%}[/{style}]"
+        else:
+            shown = f"[dim]{change:+.0%}[/dim]"
+        table.add_row(name, f"{base:.4g}", f"{value:.4g}", shown)
+
+    console.print(table)
+    return 1 if regressions else 0
+
+
+def compact(output_dir: Path, repeat: int) -> int:
+    """Compare sizes and parse times of the JSON and compact encodings."""
+    formats = [fmt for fmt in main.COMPACT_FORMATS if fmt != "msgpack"]
+    try:
+        import msgpack
+
+        formats.append("msgpack")
+    except ImportError:
+        console.print("[yellow]Skipping msgpack: not installed[/yellow]")
+
+    table = Table(title="Compact encodings")
+    for column in ("File", "Bytes", "Gzipped", "Parse ms"):
+        table.add_column(column, justify="left" if column == "File" else "right")
+
+    def best_of(fn) -> float:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000
+
+    def add_row(path: Path, parse) -> None:
+        data = path.read_bytes()
+        table.add_row(
+            path.name,
+            f"{len(data):,}",
+            f"{len(gzip.compress(data)):,}",
+            f"{best_of(lambda: parse(data)):.1f}",
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in main.ITEM_KEYS:
+            if not (output_dir / name).exists():
+                continue
+            path = Path(tmp) / name
+            shutil.copy(output_dir / name, path)
+            # Checks each encoding decodes back to the original
+            main.write_compact(path, formats)
+            add_row(path, json.loads)
+            add_row(
+                path.with_name(path.stem + ".compact.json"),
+                lambda data: main.compact_decode(json.loads(data)),
+            )
+            if "msgpack" in formats:
+                add_row(
+                    path.with_name(path.stem + ".msgpack"),
+                    lambda data: main.compact_decode(msgpack.unpackb(data)),
+                )
+
+    console.print(table)
+    return 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="MatrUSP scraper benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    cmd = sub.add_parser("conformance", help="Compare parser backends on saved pages")
+    cmd.add_argument("pages_dir", type=Path, help="Directory of saved pages")
+
+    cmd = sub.add_parser("replay", help="Benchmark a full scrape of a recording")
+    cmd.add_argument("pages_dir", type=Path, help="Directory written by --record")
+    cmd.add_argument(
+        "--latency", type=float, default=0, help="Per-request latency in ms"
+    )
+    cmd.add_argument("--parser", choices=main.PARSERS, default="html5lib")
+    cmd.add_argument("--concurrency", "-c", type=int, default=50)
+    cmd.add_argument("--repeat", type=int, default=10, help="Best of this many runs")
+    cmd.add_argument("--baseline", type=Path, help="Compare with this baseline")
+    cmd.add_argument("--save-baseline", type=Path, help="Write results here")
+    cmd.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed relative regression against the baseline",
+    )
+
+    cmd = sub.add_parser("micro", help="Time the table parsers on saved pages")
+    cmd.add_argument("pages_dir", type=Path, help="Directory of saved pages")
+    cmd.add_argument("--parser", choices=main.PARSERS, default="html5lib")
+    cmd.add_argument("--repeat", type=int, default=20, help="Best of this many runs")
+
+    cmd = sub.add_parser("compact", help="Size and parse time of compact encodings")
+    cmd.add_argument("output_dir", type=Path, help="Directory with db.json/cursos.json")
+    cmd.add_argument("--repeat", type=int, default=5, help="Best of this many parses")
+
+    args = parser.parse_args()
+
+    if args.command == "conformance":
+        sys.exit(conformance(args.pages_dir))
+    elif args.command == "replay":
+        metrics = replay(
+            args.pages_dir,
+            args.latency / 1000,
+            args.parser,
+            args.concurrency,
+            args.repeat,
+        )
+        baseline = json.loads(args.baseline.read_text()) if args.baseline else {}
+        status = compare(metrics, baseline, args.tolerance)
+        if args.save_baseline:
+            args.save_baseline.write_text(json.dumps(metrics, indent=2) + "\n")
+        sys.exit(status)
+    elif args.command == "micro":
+        sys.exit(micro(args.pages_dir, args.parser, args.repeat))
+    elif args.command == "compact":
+        sys.exit(compact(args.output_dir, args.repeat))
+
+
+if __name__ == "__main__":
+    main_cli()
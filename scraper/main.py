@@ -8,19 +8,39 @@ Usage:
     uv run main.py ../public/db
     uv run main.py ../public/db --units 45 55
     uv run main.py ../public/db --cursos
+    uv run main.py ../public/db --all
+    uv run main.py shard-1 --all --shard 1/4
+    uv run main.py merge ../public/db shard-1 shard-2 shard-3 shard-4
+    uv run --extra fast main.py ../public/db --parser selectolax
 """
 
 import asyncio
+import gc
+import hashlib
 import json
+import os
+import random
 import re
+import resource
+import sqlite3
+import sys
 import time
+import unicodedata
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import date
+from functools import lru_cache, partial
 from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterable, Iterator, NamedTuple
 
 import httpx
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, FeatureNotFound
 from dateutil import parser as dateparser
 from rich.console import Console
-from rich.progress import Progress, TaskID
+from rich.progress import Progress
+from rich.table import Table as RichTable
 
 console = Console()
 
@@ -84,9 +104,187 @@ for codes, campus in [
     for code in codes:
         CAMPUS_BY_UNIT[code] = campus
 
-# Global state
-unit_codes: dict[str, str] = {}  # unit name -> code
-semaphore: asyncio.Semaphore
+# Global state; everything else a run needs is on its Fetcher
+metrics: "Metrics"  # created below
+
+
+# ============================================
+# Metrics
+# ============================================
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class Metrics:
+    """Run metrics: stage timers, per-endpoint request latencies, sizes and
+    retries, per-parser page times, and garbage collector pauses."""
+
+    def __init__(self):
+        self.stages: dict[str, float] = defaultdict(float)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.bytes: dict[str, int] = defaultdict(int)
+        self.retries: dict[str, int] = defaultdict(int)
+        self.parses: dict[str, list[float]] = defaultdict(list)
+        self.extra: dict[str, dict] = {}
+        self.gc_collections = [0, 0, 0]  # by generation
+        self.gc_pause = 0.0
+        self._gc_start = 0.0
+        gc.callbacks.append(self._on_gc)
+
+    def _on_gc(self, phase: str, info: dict) -> None:
+        if phase == "start":
+            self._gc_start = time.perf_counter()
+        else:
+            self.gc_pause += time.perf_counter() - self._gc_start
+            self.gc_collections[info["generation"]] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def request(self, endpoint: str, latency: float, size: int) -> None:
+        self.latencies[endpoint].append(latency)
+        self.bytes[endpoint] += size
+
+    def to_dict(self) -> dict:
+        def distribution(values: list[float]) -> dict:
+            values = sorted(values)
+            return {
+                "count": len(values),
+                "total_s": round(sum(values), 3),
+                **{
+                    f"p{q}_ms": round(percentile(values, q) * 1000, 2)
+                    for q in (50, 95, 99)
+                },
+                "max_ms": round(values[-1] * 1000, 2) if values else 0,
+            }
+
+        return {
+            "stages_s": {k: round(v, 3) for k, v in self.stages.items()},
+            "endpoints": {
+                endpoint: {
+                    **distribution(latencies),
+                    "bytes": self.bytes[endpoint],
+                    "retries": self.retries[endpoint],
+                }
+                for endpoint, latencies in sorted(self.latencies.items())
+            },
+            "parsers": {
+                name: distribution(times) for name, times in sorted(self.parses.items())
+            },
+            "memory": {
+                "peak_rss_mb": round(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+                ),
+                "gc_collections": self.gc_collections,
+                "gc_pause_s": round(self.gc_pause, 3),
+            },
+            **self.extra,
+        }
+
+    def pages(self) -> int:
+        return sum(len(times) for times in self.parses.values())
+
+    def print(self) -> None:
+        data = self.to_dict()
+        table = RichTable(title="Run metrics")
+        for column in ("", "count", "p50 ms", "p95 ms", "p99 ms", "MB", "retries"):
+            table.add_column(column, justify="left" if not column else "right")
+        for name, row in data["endpoints"].items():
+            table.add_row(
+                name,
+                str(row["count"]),
+                f"{row['p50_ms']:.0f}",
+                f"{row['p95_ms']:.0f}",
+                f"{row['p99_ms']:.0f}",
+                f"{row['bytes'] / 1e6:.1f}",
+                str(row["retries"]),
+            )
+        for name, row in data["parsers"].items():
+            table.add_row(
+                name,
+                str(row["count"]),
+                f"{row['p50_ms']:.1f}",
+                f"{row['p95_ms']:.1f}",
+                f"{row['p99_ms']:.1f}",
+                "",
+                "",
+            )
+        console.print(table)
+        console.print(
+            "Stages: " + ", ".join(f"{k} {v:.1f}s" for k, v in data["stages_s"].items())
+        )
+        memory = data["memory"]
+        console.print(
+            f"Memory: peak RSS {memory['peak_rss_mb']:.0f} MB, "
+            f"{sum(memory['gc_collections'])} GC collections "
+            f"pausing {memory['gc_pause_s']:.2f}s"
+        )
+
+    def markdown(self) -> str:
+        """Render the metrics for the GitHub step summary."""
+        data = self.to_dict()
+        lines = [
+            "### Scraper metrics",
+            "",
+            "| Stage | Seconds |",
+            "| --- | ---: |",
+            *(f"| {k} | {v:.1f} |" for k, v in data["stages_s"].items()),
+            "",
+            "| Endpoint / parser | Count | p50 ms | p95 ms | p99 ms | MB | Retries |",
+            "| --- | ---: | ---: | ---: | ---: | ---: | ---: |",
+        ]
+        for name, row in data["endpoints"].items():
+            lines.append(
+                f"| {name} | {row['count']} | {row['p50_ms']:.0f} | "
+                f"{row['p95_ms']:.0f} | {row['p99_ms']:.0f} | "
+                f"{row['bytes'] / 1e6:.1f} | {row['retries']} |"
+            )
+        for name, row in data["parsers"].items():
+            lines.append(
+                f"| {name} | {row['count']} | {row['p50_ms']:.1f} | "
+                f"{row['p95_ms']:.1f} | {row['p99_ms']:.1f} | | |"
+            )
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def profiled(path: Path | None):
+    """Profile the block into path: pyinstrument HTML for .html, else cProfile."""
+    if path is None:
+        yield
+    elif path.suffix == ".html":
+        from pyinstrument import Profiler
+
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            path.write_text(profiler.output_html())
+    else:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
 
 
 def to_int(s: str) -> int:
@@ -101,74 +299,454 @@ def is_leaf_table(tag) -> bool:
     return tag.name == "table" and tag.table is None
 
 
+# ============================================
+# HTML Backends
+# ============================================
+
+# The parsers below never touch a parser-specific tree. Each backend turns a
+# page into Tables/Links, so switching the backend cannot change the output.
+PARSERS = ("html5lib", "lxml", "selectolax")
+
+
+class Row(NamedTuple):
+    """A <tr>: its stripped strings and the stripped strings of each <td>."""
+
+    strings: tuple[str, ...]
+    cells: tuple[tuple[str, ...], ...]
+
+
+class Table(NamedTuple):
+    """A leaf <table>: its raw text nodes and its rows."""
+
+    strings: tuple[str, ...]
+    rows: tuple[Row, ...]
+
+    def stripped_strings(self) -> list[str]:
+        return [s for s in (x.strip() for x in self.strings) if s]
+
+
+class Link(NamedTuple):
+    """An <a href>: its href, its bs4-style `.string` and its enclosing row."""
+
+    href: str
+    string: str | None
+    row: Row | None
+
+
+class SoupDocument:
+    """Document backed by BeautifulSoup (html5lib or lxml tree builder)."""
+
+    def __init__(self, text: str, parser: str):
+        self.soup = BeautifulSoup(text, parser)
+
+    def leaf_tables(self) -> list[Table]:
+        return [
+            Table(
+                tuple(table.strings),
+                tuple(
+                    Row(
+                        tuple(tr.stripped_strings),
+                        tuple(tuple(td.stripped_strings) for td in tr.find_all("td")),
+                    )
+                    for tr in table.find_all("tr")
+                ),
+            )
+            for table in self.soup.find_all(is_leaf_table)
+        ]
+
+    def links(self, pattern: re.Pattern, with_row: bool = False) -> list[Link]:
+        links = []
+        for a in self.soup.find_all("a", href=pattern):
+            row = None
+            if with_row and (tr := a.find_parent("tr")):
+                row = Row(
+                    tuple(tr.stripped_strings),
+                    tuple(tuple(td.stripped_strings) for td in tr.find_all("td")),
+                )
+            links.append(Link(a.get("href", ""), a.string, row))
+        return links
+
+    def text(self) -> str:
+        return self.soup.get_text()
+
+
+class SelectolaxDocument:
+    """Document backed by selectolax's lexbor parser."""
+
+    SKIP = frozenset(("script", "style", "template", "-comment"))
+
+    def __init__(self, text: str):
+        from selectolax.lexbor import LexborHTMLParser
+
+        self.tree = LexborHTMLParser(text)
+
+    def leaf_tables(self) -> list[Table]:
+        tables = self.tree.css("table")
+        leaves = []
+        for i, table in enumerate(tables):
+            # Tables come in document order, so a table has a nested table iff
+            # the very next one is inside it.
+            if i + 1 < len(tables) and self._contains(table, tables[i + 1]):
+                continue
+            strings: list[str] = []
+            rows: list[Row] = []
+            self._walk(table, strings, rows, None, None)
+            leaves.append(Table(tuple(strings), tuple(rows)))
+        return leaves
+
+    def links(self, pattern: re.Pattern, with_row: bool = False) -> list[Link]:
+        links = []
+        for a in self.tree.css("a[href]"):
+            href = a.attributes.get("href") or ""
+            if not pattern.search(href):
+                continue
+            row = None
+            if with_row:
+                tr = a.parent
+                while tr is not None and tr.tag != "tr":
+                    tr = tr.parent
+                if tr is not None:
+                    row = Row(
+                        tuple(self._stripped(tr)),
+                        tuple(tuple(self._stripped(td)) for td in tr.css("td")),
+                    )
+            links.append(Link(href, self._string(a), row))
+        return links
+
+    def text(self) -> str:
+        return "".join(
+            node.text_content
+            for node in self.tree.root.traverse(include_text=True)
+            if node.tag == "-text" and node.parent.tag not in self.SKIP
+        )
+
+    @staticmethod
+    def _contains(outer, inner) -> bool:
+        node = inner.parent
+        while node is not None:
+            if node.mem_id == outer.mem_id:
+                return True
+            node = node.parent
+        return False
+
+    @classmethod
+    def _stripped(cls, node) -> list[str]:
+        return [
+            s
+            for s in (
+                n.text_content.strip()
+                for n in node.traverse(include_text=True)
+                if n.tag == "-text" and n.parent.tag not in cls.SKIP
+            )
+            if s
+        ]
+
+    @classmethod
+    def _string(cls, node) -> str | None:
+        """Mirror bs4's `Tag.string`: the text of a single-child chain."""
+        child = node.child
+        if child is None or child.next is not None:
+            return None
+        if child.tag == "-text":
+            return child.text_content
+        return cls._string(child)
+
+    @classmethod
+    def _walk(cls, node, strings, rows, row, cell) -> None:
+        """Collect text nodes, rows and cells of a leaf table in one pass."""
+        for child in node.iter(include_text=True):
+            tag = child.tag
+            if tag == "-text":
+                text = child.text_content
+                strings.append(text)
+                text = text.strip()
+                if text:
+                    if row is not None:
+                        row[0].append(text)
+                    if cell is not None:
+                        cell.append(text)
+            elif tag in cls.SKIP:
+                continue
+            elif tag == "tr":
+                new_row: tuple[list, list] = ([], [])
+                cls._walk(child, strings, rows, new_row, None)
+                rows.append(Row(tuple(new_row[0]), tuple(tuple(c) for c in new_row[1])))
+            elif tag == "td" and row is not None:
+                new_cell: list[str] = []
+                row[1].append(new_cell)
+                cls._walk(child, strings, rows, row, new_cell)
+            else:
+                cls._walk(child, strings, rows, row, cell)
+
+
+def parse_html(
+    text: str, parser: str = "html5lib"
+) -> SoupDocument | SelectolaxDocument:
+    """Parse a page with the given backend."""
+    if parser == "selectolax":
+        return SelectolaxDocument(text)
+    return SoupDocument(text, parser)
+
+
+# ============================================
+# Records
+# ============================================
+
+# Parsed pages are held as slotted records instead of dicts: no per-object
+# __dict__, and the strings repeated across every classroom (days, times,
+# professors, classroom and group types) are interned so each is stored once.
+# json_default turns them back into exactly the dicts they replace.
+
+# Classroom key orders seen so far, so classrooms share one tuple each
+KEY_ORDERS: dict[tuple[str, ...], tuple[str, ...]] = {}
+
+
+def json_default(obj):
+    """`default` for json.dumps: serialize records as the dicts they replace."""
+    try:
+        return obj.to_json()
+    except AttributeError:
+        raise TypeError(f"{type(obj).__name__} is not JSON serializable") from None
+
+
+class Schedule:
+    """One time slot of a classroom."""
+
+    __slots__ = ("dia", "inicio", "fim", "professores")
+
+    def __init__(self, dia: str, inicio: str, fim: str, professores: list[str]):
+        self.dia = sys.intern(dia)
+        self.inicio = sys.intern(inicio)
+        self.fim = sys.intern(fim)
+        self.professores = professores
+
+    def add_professor(self, name: str) -> None:
+        self.professores.append(sys.intern(name))
+
+    def to_json(self) -> dict:
+        return {
+            "dia": self.dia,
+            "inicio": self.inicio,
+            "fim": self.fim,
+            "professores": self.professores,
+        }
+
+
+class Vacancy:
+    """Vacancy counts of a classroom for one type of student, or one group."""
+
+    __slots__ = ("vagas", "inscritos", "pendentes", "matriculados", "grupos")
+
+    def __init__(self, counts: list[str], grupos: dict | None = None):
+        self.vagas, self.inscritos, self.pendentes, self.matriculados = map(
+            to_int, counts
+        )
+        self.grupos = grupos
+
+    def to_json(self) -> dict:
+        data = {
+            "vagas": self.vagas,
+            "inscritos": self.inscritos,
+            "pendentes": self.pendentes,
+            "matriculados": self.matriculados,
+        }
+        if self.grupos is not None:
+            data["grupos"] = self.grupos
+        return data
+
+
+class Classroom:
+    """A classroom (turma). Info fields keep the order the page listed them
+    in, and are None when it did not."""
+
+    __slots__ = (
+        "keys",
+        "codigo",
+        "codigo_teorica",
+        "inicio",
+        "fim",
+        "tipo",
+        "observacoes",
+        "horario",
+        "vagas",
+    )
+
+    def __init__(self, info: dict[str, str]):
+        keys = tuple(info)
+        self.keys = KEY_ORDERS.setdefault(keys, keys)
+        self.codigo = info.get("codigo")
+        self.codigo_teorica = info.get("codigo_teorica")
+        self.inicio = info.get("inicio")
+        self.fim = info.get("fim")
+        tipo = info.get("tipo")
+        self.tipo = sys.intern(tipo) if tipo is not None else None
+        self.observacoes = info.get("observacoes")
+        self.horario: list[Schedule] = []
+        self.vagas: dict[str, Vacancy] = {}
+
+    def to_json(self) -> dict:
+        data = {key: getattr(self, key) for key in self.keys}
+        data["horario"] = self.horario
+        data["vagas"] = self.vagas
+        return data
+
+
+class Lecture:
+    """A lecture: its obterDisciplina info, shared with the metadata store,
+    and its classrooms."""
+
+    __slots__ = ("info", "turmas")
+
+    def __init__(self, info: dict, turmas: list[Classroom]):
+        self.info = info
+        self.turmas = turmas
+
+    def get(self, key: str, default=None):
+        return self.turmas if key == "turmas" else self.info.get(key, default)
+
+    def to_json(self) -> dict:
+        return {**self.info, "turmas": self.turmas}
+
+
+class CourseEntry:
+    """A lecture in a course period. Requirement lists start as a shared
+    empty tuple and become lists on the first requirement."""
+
+    __slots__ = ("codigo", "tipo", "req_fraco", "req_forte", "ind_conjunto")
+
+    def __init__(self, codigo: str, tipo: str):
+        self.codigo = codigo
+        self.tipo = tipo
+        self.req_fraco = self.req_forte = self.ind_conjunto = ()
+
+    def add_requirement(self, field: str, codigo: str) -> None:
+        requirements = getattr(self, field)
+        if not requirements:
+            requirements = []
+            setattr(self, field, requirements)
+        requirements.append(codigo)
+
+    def to_json(self) -> dict:
+        return {
+            "codigo": self.codigo,
+            "tipo": self.tipo,
+            "req_fraco": self.req_fraco,
+            "req_forte": self.req_forte,
+            "ind_conjunto": self.ind_conjunto,
+        }
+
+
 # ============================================
 # Lecture Parsing
 # ============================================
 
+# Compiled once: these run for every row of every table of every page
+RE_CODIGO_TURMA = re.compile(r"Código\s+da\s+Turma")
+RE_TURMA_CODE = re.compile(r"^(\w+)")
+RE_DISCIPLINA = re.compile(r"Disciplina:\s+.{7}\s+-.+")
+RE_DISCIPLINA_NAME = re.compile(r"Disciplina:\s+([A-Z0-9\s]{7})\s-\s(.+)")
+RE_CREDITOS_AULA = re.compile(r"Créditos\s+Aula")
+RE_ATIVIDADES = re.compile(r"Atividades\s+Didáticas")
+
+
+RE_DATE = re.compile(r"[ \t\r\n]*(\d{1,2})/(\d{1,2})/(\d{4})[ \t\r\n]*")
+
+
+@lru_cache(maxsize=4096)
+def format_date(text: str) -> str:
+    """Normalize a date to DD/MM/YYYY, reading it day first.
+
+    JupiterWeb always writes DD/MM/YYYY, so that is parsed directly, and
+    cached as a semester only has a few hundred distinct dates; anything
+    else, including impossible dates, goes to dateutil as before.
+    """
+    if match := RE_DATE.fullmatch(text):
+        day, month, year = map(int, match.groups())
+        try:
+            date(year, month, day)
+        except ValueError:
+            pass
+        else:
+            if year >= 1000:
+                return f"{day:02d}/{month:02d}/{year}"
+    return dateparser.parse(text, dayfirst=True).strftime("%d/%m/%Y")
+
+
+def turma_code(text: str) -> str | None:
+    match = RE_TURMA_CODE.match(text)
+    return match.group(1) if match else None
+
 
-def parse_schedule(table) -> list[dict]:
+# Classroom info rows, by label: the first matching pattern sets its field to
+# the converted value, unless that is None
+CLASSROOM_FIELDS = (
+    (re.compile(r"Código\s+da\s+Turma\s+Teórica"), "codigo_teorica", str),
+    (RE_CODIGO_TURMA, "codigo", turma_code),
+    (re.compile(r"Início"), "inicio", format_date),
+    (re.compile(r"Fim"), "fim", format_date),
+    (re.compile(r"Tipo\s+da\s+Turma"), "tipo", str),
+    (re.compile(r"Observações"), "observacoes", str),
+)
+
+CREDIT_FIELDS = (
+    (re.compile(r"Créditos\s+Aula:"), "creditos_aula"),
+    (re.compile(r"Créditos\s+Trabalho:"), "creditos_trabalho"),
+)
+
+
+def parse_schedule(table: Table) -> list[Schedule]:
     """Parse schedule table into list of time slots."""
     schedule = []
     current = None
 
-    for tr in table.find_all("tr"):
-        tds = ["".join(x.stripped_strings).strip() for x in tr.find_all("td")]
+    for row in table.rows:
+        tds = ["".join(cell) for cell in row.cells]
         if not tds or tds[0] == "Horário":
             continue
 
         if tds[0]:  # New day
             if current:
                 schedule.append(current)
-            current = [tds[0], tds[1], tds[2], [tds[3]] if len(tds) > 3 else []]
+            current = Schedule(tds[0], tds[1], tds[2], [])
+            if len(tds) > 3:
+                current.add_professor(tds[3])
         elif current:
             # Additional time or professor
             if tds[1] == "" and len(tds) > 2:
-                if tds[2] > current[2]:
-                    current[2] = tds[2]
+                if tds[2] > current.fim:
+                    current.fim = sys.intern(tds[2])
                 if len(tds) > 3 and tds[3]:
-                    current[3].append(tds[3])
+                    current.add_professor(tds[3])
             elif tds[1] and len(tds) > 2:
                 schedule.append(current)
-                current = [current[0], tds[1], tds[2], [tds[3]] if len(tds) > 3 else []]
+                current = Schedule(current.dia, tds[1], tds[2], [])
+                if len(tds) > 3:
+                    current.add_professor(tds[3])
 
     if current:
         schedule.append(current)
 
-    return [
-        {"dia": h[0], "inicio": h[1], "fim": h[2], "professores": h[3]}
-        for h in schedule
-    ]
+    return schedule
 
 
-def parse_vacancies(table) -> dict:
+def parse_vacancies(table: Table) -> dict[str, Vacancy]:
     """Parse vacancy table."""
     vacancies = {}
     current_type = None
     current_data = None
 
-    for tr in table.find_all("tr"):
-        tds = ["".join(x.stripped_strings).strip() for x in tr.find_all("td")]
+    for row in table.rows:
+        tds = ["".join(cell) for cell in row.cells]
 
         if len(tds) == 5 and tds[0] == "":
             continue
         elif len(tds) == 5 and tds[0]:
             if current_type and current_data:
                 vacancies[current_type] = current_data
-            current_type = tds[0]
-            current_data = {
-                "vagas": to_int(tds[1]),
-                "inscritos": to_int(tds[2]),
-                "pendentes": to_int(tds[3]),
-                "matriculados": to_int(tds[4]),
-                "grupos": {},
-            }
+            current_type = sys.intern(tds[0])
+            current_data = Vacancy(tds[1:], {})
         elif len(tds) == 6 and current_data:
-            current_data["grupos"][tds[1]] = {
-                "vagas": to_int(tds[2]),
-                "inscritos": to_int(tds[3]),
-                "pendentes": to_int(tds[4]),
-                "matriculados": to_int(tds[5]),
-            }
+            current_data.grupos[sys.intern(tds[1])] = Vacancy(tds[2:])
 
     if current_type and current_data:
         vacancies[current_type] = current_data
@@ -176,106 +754,140 @@ def parse_vacancies(table) -> dict:
     return vacancies
 
 
-def parse_classroom_info(table) -> dict:
-    """Parse classroom info table."""
+def parse_classroom_info(table: Table, fields=CLASSROOM_FIELDS) -> Classroom:
+    """Parse classroom info table, looking for the given CLASSROOM_FIELDS."""
     info = {}
-    for tr in table.find_all("tr"):
+    for row in table.rows:
         try:
-            tds = [next(x.stripped_strings) for x in tr.find_all("td")]
-            if len(tds) < 2:
-                continue
-
-            if re.search(r"Código\s+da\s+Turma\s+Teórica", tds[0], re.U):
-                info["codigo_teorica"] = tds[1]
-            elif re.search(r"Código\s+da\s+Turma", tds[0], re.U):
-                match = re.match(r"^(\w+)", tds[1], re.U)
-                if match:
-                    info["codigo"] = match.group(1)
-            elif re.search(r"Início", tds[0], re.U):
-                info["inicio"] = dateparser.parse(tds[1], dayfirst=True).strftime(
-                    "%d/%m/%Y"
-                )
-            elif re.search(r"Fim", tds[0], re.U):
-                info["fim"] = dateparser.parse(tds[1], dayfirst=True).strftime(
-                    "%d/%m/%Y"
-                )
-            elif re.search(r"Tipo\s+da\s+Turma", tds[0], re.U):
-                info["tipo"] = tds[1]
-            elif re.search(r"Observações", tds[0], re.U):
-                info["observacoes"] = tds[1]
-        except (StopIteration, IndexError):
+            tds = [cell[0] for cell in row.cells]
+        except IndexError:
+            continue
+        if len(tds) < 2:
             continue
 
-    return info
+        for pattern, field, convert in fields:
+            if pattern.search(tds[0]):
+                value = convert(tds[1])
+                if value is not None:
+                    info[field] = value
+                break
+
+    return Classroom(info)
+
+
+def has_schedule(table: Table) -> bool:
+    """Whether parse_schedule(table) would find any time slot."""
+    return any(
+        row.cells and "".join(row.cells[0]) not in ("", "Horário") for row in table.rows
+    )
 
 
-def parse_classrooms(tables) -> list[dict]:
+def classify_classroom_table(table: Table) -> str | None:
+    """The kind of an obterTurma leaf table, from one join of its text nodes.
+
+    Returns "info", "schedule", "activities", "vacancies" or None, checked in
+    that order. Substring tests skip the regexes on tables that cannot match.
+    """
+    text = "\0".join(table.strings)
+    if "Código" in text and RE_CODIGO_TURMA.search(text):
+        return "info"
+    if "Horário" in table.strings:
+        return "schedule"
+    if "Atividades" in text and RE_ATIVIDADES.search(text):
+        return "activities"
+    if "Vagas" in table.strings:
+        return "vacancies"
+    return None
+
+
+def parse_classrooms(tables: list[Table]) -> list[Classroom]:
     """Parse all classrooms from leaf tables."""
     classrooms = []
     info = schedule = vacancies = None
 
     for table in tables:
-        if table.find_all(string=re.compile(r"Código\s+da\s+Turma", re.U)):
-            if info and info.get("codigo"):
+        kind = classify_classroom_table(table)
+        if kind == "info":
+            if info and info.codigo:
                 if schedule and vacancies:
-                    info["horario"] = schedule
-                    info["vagas"] = vacancies
+                    info.horario = schedule
+                    info.vagas = vacancies
                     classrooms.append(info)
             info = parse_classroom_info(table)
             schedule = vacancies = None
-        elif table.find_all(string="Horário"):
+        elif kind == "schedule":
             schedule = parse_schedule(table)
-        elif table.find_all(string=re.compile(r"Atividades\s+Didáticas", re.U)):
-            continue
-        elif table.find_all(string="Vagas"):
+        elif kind == "vacancies":
             vacancies = parse_vacancies(table)
 
-    if info and info.get("codigo") and schedule and vacancies:
-        info["horario"] = schedule
-        info["vagas"] = vacancies
+    if info and info.codigo and schedule and vacancies:
+        info.horario = schedule
+        info.vagas = vacancies
         classrooms.append(info)
 
     return classrooms
 
 
-def parse_credits(table) -> dict:
+def parse_classroom_vacancies(tables: list[Table]) -> dict[str, dict[str, Vacancy]]:
+    """Turma codigo -> vacancies of the classrooms parse_classrooms would
+    return, without parsing their dates and schedules."""
+    classrooms = {}
+    codigo = schedule = vacancies = None
+
+    for table in tables:
+        kind = classify_classroom_table(table)
+        if kind == "info":
+            if codigo and schedule and vacancies:
+                classrooms[codigo] = vacancies
+            # Only the codigo and, as it comes first, codigo_teorica
+            codigo = parse_classroom_info(table, CLASSROOM_FIELDS[:2]).codigo
+            schedule = vacancies = None
+        elif kind == "schedule":
+            schedule = has_schedule(table)
+        elif kind == "vacancies":
+            vacancies = parse_vacancies(table)
+
+    if codigo and schedule and vacancies:
+        classrooms[codigo] = vacancies
+    return classrooms
+
+
+def parse_credits(table: Table) -> dict:
     """Parse credits table."""
     credits = {"creditos_aula": 0, "creditos_trabalho": 0}
-    for tr in table.find_all("tr"):
+    for row in table.rows:
         try:
-            tds = [next(x.stripped_strings) for x in tr.find_all("td")]
-            if len(tds) < 2:
-                continue
-            if re.search(r"Créditos\s+Aula:", tds[0], re.U):
-                credits["creditos_aula"] = to_int(tds[1])
-            elif re.search(r"Créditos\s+Trabalho:", tds[0], re.U):
-                credits["creditos_trabalho"] = to_int(tds[1])
-        except StopIteration:
+            tds = [cell[0] for cell in row.cells]
+        except IndexError:
+            continue
+        if len(tds) < 2:
             continue
+        for pattern, field in CREDIT_FIELDS:
+            if pattern.search(tds[0]):
+                credits[field] = to_int(tds[1])
+                break
     return credits
 
 
-def parse_lecture_info(tables) -> dict:
+def parse_lecture_info(tables: list[Table], unit_codes: dict[str, str]) -> dict:
     """Parse lecture info from leaf tables."""
     info = {}
-    re_nome = re.compile(r"Disciplina:\s+.{7}\s+-.+")
-    re_credits = re.compile(r"Créditos\s+Aula")
 
     for table in tables:
-        if table.find(string=re_nome):
-            strings = list(table.stripped_strings)
-            info["unidade"] = strings[0]
-            info["departamento"] = strings[1]
+        if any(RE_DISCIPLINA.search(s) for s in table.strings):
+            strings = table.stripped_strings()
+            info["unidade"] = sys.intern(strings[0])
+            info["departamento"] = sys.intern(strings[1])
             unit_code = unit_codes.get(info["unidade"])
             info["campus"] = (
                 CAMPUS_BY_UNIT.get(int(unit_code), "Outro") if unit_code else "Outro"
             )
 
-            match = re.search(r"Disciplina:\s+([A-Z0-9\s]{7})\s-\s(.+)", strings[2])
+            match = RE_DISCIPLINA_NAME.search(strings[2])
             if match:
                 info["codigo"] = match.group(1)
                 info["nome"] = match.group(2)
-        elif table.find(string=re_credits):
+        elif any(RE_CREDITOS_AULA.search(s) for s in table.strings):
             info.update(parse_credits(table))
 
     return info
@@ -285,356 +897,3041 @@ def parse_lecture_info(tables) -> dict:
 # Course Parsing
 # ============================================
 
+RE_WHITESPACE = re.compile(r"\s+")
+RE_PERIODO_IDEAL = re.compile(r"(\d+)º Período Ideal")
+RE_COURSE_CODE = re.compile(r"codcur=(.+?)&codhab=(.+?)(&|$)")
+RE_COURSE_NAME = re.compile(r"Curso:\s*(.+?)\s*(?:\n|$)")
+RE_CODCG = re.compile(r"codcg=(\d+)")
+RE_OBRIGATORIAS = re.compile(r"Disciplinas\s+Obrigatórias")
 
-def parse_course_periods(table) -> dict:
-    """Parse course curriculum periods."""
-    periods: dict[str, list] = {}
-    tipo_map = {
-        "Disciplinas Obrigatórias": "obrigatoria",
-        "Disciplinas Optativas Eletivas": "optativa_eletiva",
-        "Disciplinas Optativas Livres": "optativa_livre",
-    }
+COURSE_TIPOS = {
+    "Disciplinas Obrigatórias": "obrigatoria",
+    "Disciplinas Optativas Eletivas": "optativa_eletiva",
+    "Disciplinas Optativas Livres": "optativa_livre",
+}
 
+# Requirement rows: the kind in the second cell -> the list it goes to
+REQUIREMENT_FIELDS = {
+    "Requisito fraco": "req_fraco",
+    "Requisito": "req_forte",
+    "Indicação de Conjunto": "ind_conjunto",
+}
+
+
+def parse_course_periods(table: Table) -> dict[str, list[CourseEntry]]:
+    """Parse course curriculum periods."""
+    periods: dict[str, list[CourseEntry]] = {}
     current_tipo = ""
     current_period = ""
 
-    for tr in table.find_all("tr"):
-        text = re.sub(r"\s+", " ", next(tr.stripped_strings, ""))
+    for row in table.rows:
+        text = RE_WHITESPACE.sub(" ", row.strings[0] if row.strings else "")
 
-        if text in tipo_map:
-            current_tipo = tipo_map[text]
-        elif match := re.search(r"(\d+)º Período Ideal", text):
+        if text in COURSE_TIPOS:
+            current_tipo = COURSE_TIPOS[text]
+        elif match := RE_PERIODO_IDEAL.search(text):
             current_period = match.group(1)
             if current_period not in periods:
                 periods[current_period] = []
         else:
-            try:
-                tds = [next(td.stripped_strings, "") for td in tr.find_all("td")]
-            except AttributeError:
-                continue
+            tds = [cell[0] if cell else "" for cell in row.cells]
 
             if len(tds) > 0 and len(tds[0]) == 7:
-                periods[current_period].append(
-                    {
-                        "codigo": tds[0],
-                        "tipo": current_tipo,
-                        "req_fraco": [],
-                        "req_forte": [],
-                        "ind_conjunto": [],
-                    }
-                )
+                periods[current_period].append(CourseEntry(tds[0], current_tipo))
             elif len(tds) >= 2 and periods.get(current_period):
                 last = periods[current_period][-1] if periods[current_period] else None
-                if last:
-                    code = tds[0][:7]
-                    if tds[1] == "Requisito fraco":
-                        last["req_fraco"].append(code)
-                    elif tds[1] == "Requisito":
-                        last["req_forte"].append(code)
-                    elif tds[1] == "Indicação de Conjunto":
-                        last["ind_conjunto"].append(code)
+                if last and (field := REQUIREMENT_FIELDS.get(tds[1])):
+                    last.add_requirement(field, tds[0][:7])
 
     return periods
 
 
+def parse_course(doc, link: str, period: str, unit_codes: dict[str, str]) -> dict:
+    """Parse a listarGradeCurricular page."""
+    course = {"periodo": period}
+
+    # Extract course code
+    match = RE_COURSE_CODE.search(link)
+    if match:
+        course["codigo"] = f"{match.group(1)}-{match.group(2)}"
+
+    # Extract course name
+    names = RE_COURSE_NAME.findall(doc.text())
+    course["nome"] = " - ".join(names)
+
+    # Extract unit
+    unit_match = RE_CODCG.search(link)
+    if unit_match:
+        unit_code = unit_match.group(1)
+        for name, code in unit_codes.items():
+            if code == unit_code:
+                course["unidade"] = name
+                break
+
+    # Parse periods
+    for table in doc.leaf_tables():
+        if any(RE_OBRIGATORIAS.search(s) for s in table.strings):
+            course["periodos"] = parse_course_periods(table)
+            break
+
+    return course
+
+
 # ============================================
-# Scraping Functions
+# Page Parsers
 # ============================================
 
+# Whole-page parsers. They only take picklable arguments (no globals), so they
+# can run in the parse pool as well as on the event loop.
+
+RE_UNIT_LINK = re.compile("jupColegiadoMenu")
+RE_LECTURE_LINK = re.compile("obterTurma")
+RE_COURSE_LINK = re.compile("listarGradeCurricular")
+RE_SGLDIS = re.compile(r"sgldis=([A-Z0-9\s]{7})")
 
-async def fetch_units(client: httpx.AsyncClient) -> dict[str, str]:
-    """Fetch all teaching units."""
-    resp = await client.get(
-        "https://uspdigital.usp.br/jupiterweb/jupColegiadoLista?tipo=T", timeout=60
-    )
-    soup = BeautifulSoup(resp.text, "html5lib")
-    links = soup.find_all("a", href=re.compile("jupColegiadoMenu"))
 
+def parse_units_page(text: str, parser: str) -> dict[str, str]:
+    """Parse jupColegiadoLista into unit name -> code."""
     units = {}
-    for link in links:
-        match = re.search(r"codcg=(\d+)", link.get("href", ""))
+    for link in parse_html(text, parser).links(RE_UNIT_LINK):
+        match = RE_CODCG.search(link.href)
         if match and link.string:
             units[link.string] = match.group(1)
-
     return units
 
 
-async def fetch_unit_lectures(
-    client: httpx.AsyncClient, unit_code: str
-) -> list[tuple[str, str]]:
-    """Fetch all lectures from a unit."""
-    url = f"https://uspdigital.usp.br/jupiterweb/jupDisciplinaLista?letra=A-Z&tipo=T&codcg={unit_code}"
-    resp = await client.get(url, timeout=120)
-    soup = BeautifulSoup(resp.text, "html5lib")
-
+def parse_unit_lectures_page(text: str, parser: str) -> list[tuple[str, str]]:
+    """Parse jupDisciplinaLista into (codigo, nome) pairs."""
     lectures = []
-    for link in soup.find_all("a", href=re.compile("obterTurma")):
-        match = re.search(r"sgldis=([A-Z0-9\s]{7})", link.get("href", ""))
+    for link in parse_html(text, parser).links(RE_LECTURE_LINK):
+        match = RE_SGLDIS.search(link.href)
         if match:
             lectures.append((match.group(1), link.string or ""))
-
     return lectures
 
 
-async def fetch_lecture(
-    client: httpx.AsyncClient,
-    codigo: str,
-    nome: str,
-    timeout: int,
-    progress: Progress,
-    task: TaskID,
-) -> dict | None:
-    """Fetch and parse a single lecture."""
-    async with semaphore:
-        try:
-            # Fetch classrooms
-            url = f"https://uspdigital.usp.br/jupiterweb/obterTurma?print=true&sgldis={codigo}"
-            resp = await client.get(url, timeout=timeout)
-            soup = BeautifulSoup(resp.text, "html5lib")
-            classrooms = parse_classrooms(soup.find_all(is_leaf_table))
-
-            if not classrooms:
-                progress.advance(task)
-                return None
-
-            # Fetch lecture info
-            url = f"https://uspdigital.usp.br/jupiterweb/obterDisciplina?print=true&sgldis={codigo}"
-            resp = await client.get(url, timeout=timeout)
-            soup = BeautifulSoup(resp.text, "html5lib")
-            info = parse_lecture_info(soup.find_all(is_leaf_table))
-
-            if not info.get("codigo"):
-                progress.advance(task)
-                return None
-
-            info["turmas"] = classrooms
-            progress.advance(task)
-            return info
-
-        except Exception as e:
-            console.print(f"[red]Error fetching {codigo}: {e}[/red]")
-            progress.advance(task)
-            return None
+def parse_unit_courses_page(text: str, parser: str) -> list[tuple[str, str]]:
+    """Parse jupCursoLista into (link, periodo) pairs."""
+    doc = parse_html(text, parser)
+    courses = []
+    for link in doc.links(RE_COURSE_LINK, with_row=True):
+        period = ""
+        if link.row and link.row.cells and link.row.cells[-1]:
+            period = link.row.cells[-1][0]
+        courses.append((link.href, period))
+    return courses
 
 
-async def fetch_unit_courses(
-    client: httpx.AsyncClient, unit_code: str
-) -> list[tuple[str, str]]:
-    """Fetch all courses from a unit."""
-    url = f"https://uspdigital.usp.br/jupiterweb/jupCursoLista?tipo=N&codcg={unit_code}"
-    resp = await client.get(url, timeout=120)
-    soup = BeautifulSoup(resp.text, "html5lib")
+def parse_turma_page(text: str, parser: str) -> list[Classroom]:
+    """Parse obterTurma into classrooms."""
+    return parse_classrooms(parse_html(text, parser).leaf_tables())
 
-    courses = []
-    for link in soup.find_all("a", href=re.compile("listarGradeCurricular")):
-        href = link.get("href", "")
-        parent_tr = link.find_parent("tr")
-        period = ""
-        if parent_tr:
-            tds = parent_tr.find_all("td")
-            if tds:
-                period = next(tds[-1].stripped_strings, "")
-        courses.append((href, period))
 
-    return courses
+def parse_turma_vacancies_page(text: str, parser: str) -> dict[str, dict[str, Vacancy]]:
+    """Parse obterTurma into turma codigo -> vacancies."""
+    return parse_classroom_vacancies(parse_html(text, parser).leaf_tables())
 
 
-async def fetch_course(
-    client: httpx.AsyncClient,
-    link: str,
-    period: str,
-    timeout: int,
-) -> dict | None:
-    """Fetch and parse a single course."""
-    async with semaphore:
-        try:
-            url = f"https://uspdigital.usp.br/jupiterweb/{link}"
-            resp = await client.get(url, timeout=timeout)
-            soup = BeautifulSoup(resp.text, "html5lib")
+def parse_disciplina_page(text: str, parser: str, unit_codes: dict[str, str]) -> dict:
+    """Parse obterDisciplina into lecture info."""
+    return parse_lecture_info(parse_html(text, parser).leaf_tables(), unit_codes)
 
-            course = {"periodo": period}
 
-            # Extract course code
-            match = re.search(r"codcur=(.+?)&codhab=(.+?)(&|$)", link)
-            if match:
-                course["codigo"] = f"{match.group(1)}-{match.group(2)}"
-
-            # Extract course name
-            names = re.findall(r"Curso:\s*(.+?)\s*(?:\n|$)", soup.get_text())
-            course["nome"] = " - ".join(names)
-
-            # Extract unit
-            unit_match = re.search(r"codcg=(\d+)", link)
-            if unit_match:
-                unit_code = unit_match.group(1)
-                for name, code in unit_codes.items():
-                    if code == unit_code:
-                        course["unidade"] = name
-                        break
-
-            # Parse periods
-            for table in soup.find_all(is_leaf_table):
-                if table.find(string=re.compile(r"Disciplinas\s+Obrigatórias")):
-                    course["periodos"] = parse_course_periods(table)
-                    break
+def parse_course_page(
+    text: str, parser: str, link: str, period: str, unit_codes: dict[str, str]
+) -> dict:
+    """Parse listarGradeCurricular into a course."""
+    return parse_course(parse_html(text, parser), link, period, unit_codes)
 
-            return course
 
-        except Exception as e:
-            console.print(f"[red]Error fetching course: {e}[/red]")
-            return None
+def timed(fn, *args):
+    """Call fn, returning its result and the time it took."""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
 
 
 # ============================================
-# Main Functions
+# HTTP Client
 # ============================================
 
+USER_AGENT = "MatrUSPbot/2.0 (+https://github.com/matrusp/matrusp)"
+
+
+class AdaptiveLimiter:
+    """AIMD limit on concurrent requests.
+
+    While responses come back quickly the limit grows by about one request
+    per round trip (additive increase); on 429, 5xx or a timeout it is halved
+    (multiplicative decrease), at most once per round trip so a burst of
+    failures from the same window only counts once.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max(min_limit, max_limit // 4))
+        self.peak = self.limit
+        self.decreases = 0
+        self.in_flight = 0
+        self.best_latency = float("inf")
+        self.latency = 0.0  # moving average
+        self.last_decrease = 0.0
+        self.changed = asyncio.Condition()
+
+    async def __aenter__(self) -> None:
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc) -> None:
+        async with self.changed:
+            self.in_flight -= 1
+            self.changed.notify_all()
+
+    def success(self, latency: float) -> None:
+        self.best_latency = min(self.best_latency, latency)
+        self.latency = 0.9 * self.latency + 0.1 * latency if self.latency else latency
+        # Only grow while latency stays healthy: a queue building up on the
+        # server side shows up as latency long before it shows up as errors.
+        if self.latency < 3 * self.best_latency:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.peak = max(self.peak, self.limit)
+
+    def overload(self) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease < max(self.latency, 1.0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit / 2)
+        self.decreases += 1
+
+
+class AdaptiveTransport(httpx.AsyncBaseTransport):
+    """Transport that paces requests with an AdaptiveLimiter and retries.
+
+    Transport errors (timeouts, dropped connections, protocol errors), 429 and
+    5xx responses are retried up to `retries` times with jittered exponential
+    backoff (honoring Retry-After, up to max_backoff) before the last error
+    is raised.
+    """
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        limiter: AdaptiveLimiter,
+        retries: int = 4,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        self.transport = transport
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = {"retries": 0, "gave_up": 0}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = request.url.path.rsplit("/", 1)[-1]
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            async with self.limiter:
+                start = time.perf_counter()
+                try:
+                    resp = await self.transport.handle_async_request(request)
+                    # Read the body while holding the slot, so it is counted
+                    # as in flight until the download is done
+                    await resp.aread()
+                except httpx.TransportError:
+                    self.limiter.overload()
+                    if attempt == self.retries:
+                        self.stats["gave_up"] += 1
+                        raise
+                else:
+                    latency = time.perf_counter() - start
+                    metrics.request(endpoint, latency, resp.num_bytes_downloaded)
+                    if resp.status_code != 429 and resp.status_code < 500:
+                        self.limiter.success(latency)
+                        return resp
+                    self.limiter.overload()
+                    if attempt == self.retries:
+                        self.stats["gave_up"] += 1
+                        return resp
+                    retry_after = to_int(resp.headers.get("Retry-After", ""))
+                    await resp.aclose()
+
+            self.stats["retries"] += 1
+            metrics.retries[endpoint] += 1
+            delay = min(self.max_backoff, self.backoff * 2**attempt)
+            if retry_after:
+                delay = min(self.max_backoff, retry_after)
+            else:
+                delay = random.uniform(delay / 2, delay)
+            await asyncio.sleep(delay)
+
+        raise AssertionError("unreachable")
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+    def summary(self) -> str:
+        limiter = self.limiter
+        return (
+            f"Concurrency: ended at {int(limiter.limit)} "
+            f"(peak {int(limiter.peak)}, cut back {limiter.decreases} times), "
+            f"{self.stats['retries']} retries, {self.stats['gave_up']} gave up"
+        )
 
-async def scrape_lectures(
-    output_dir: Path, units: list[str] | None, concurrency: int, timeout: int
-):
-    """Scrape all lectures and output db.json."""
-    global unit_codes, semaphore
-    semaphore = asyncio.Semaphore(concurrency)
-
-    output_dir.mkdir(parents=True, exist_ok=True)
 
-    async with httpx.AsyncClient(
-        headers={"User-Agent": "MatrUSPbot/2.0 (+https://github.com/matrusp/matrusp)"},
-        verify=False,
-        follow_redirects=True,
-    ) as client:
-        # Fetch units
-        console.print("[bold]Fetching teaching units...[/bold]")
-        unit_codes = await fetch_units(client)
-        console.print(f"Found {len(unit_codes)} units")
+def describe_error(e: Exception) -> str:
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"HTTP {e.response.status_code} for {e.request.url}"
+    return f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
 
-        # Save campi.json
-        campi: dict[str, list[str]] = {}
-        for unit_name, code in unit_codes.items():
-            campus = CAMPUS_BY_UNIT.get(int(code), "Outro")
-            if campus not in campi:
-                campi[campus] = []
-            campi[campus].append(unit_name)
 
-        (output_dir / "campi.json").write_text(json.dumps(campi, ensure_ascii=False))
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Transport that saves every response under `root` for --replay.
 
-        # Filter units if specified
-        target_units = units or list(unit_codes.values())
-        if units:
-            console.print(f"Filtering to {len(units)} units: {units}")
+    Bodies are saved as `<endpoint>-<url hash>.html`, which is also the layout
+    bench.py expects, and index.json maps each URL to its file.
+    """
 
-        # Fetch lecture list from all units
-        console.print("[bold]Fetching lecture list from units...[/bold]")
-        all_lectures: list[tuple[str, str]] = []
+    KEEP_HEADERS = ("content-type", "etag", "last-modified")
 
-        with Progress() as progress:
-            task = progress.add_task("Units", total=len(target_units))
-            tasks = [fetch_unit_lectures(client, code) for code in target_units]
-            results = await asyncio.gather(*tasks)
-            for lectures in results:
-                all_lectures.extend(lectures)
-                progress.advance(task)
+    def __init__(self, transport: httpx.AsyncBaseTransport, root: Path):
+        self.transport = transport
+        self.root = root
+        root.mkdir(parents=True, exist_ok=True)
+        index = root / "index.json"
+        self.index: dict[str, dict] = (
+            json.loads(index.read_text()) if index.exists() else {}
+        )
 
-        console.print(f"Found {len(all_lectures)} lectures")
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        resp = await self.transport.handle_async_request(request)
+        if resp.status_code == 304:
+            return resp
+
+        body = await resp.aread()
+        url = str(request.url)
+        endpoint = request.url.path.rsplit("/", 1)[-1]
+        name = f"{endpoint}-{hashlib.sha1(url.encode()).hexdigest()[:12]}.html"
+        (self.root / name).write_bytes(body)
+        headers = {k: v for k, v in resp.headers.items() if k in self.KEEP_HEADERS}
+        self.index[url] = {"file": name, "status": resp.status_code, "headers": headers}
+
+        # The body is already decoded, so drop the encoding headers
+        return httpx.Response(
+            resp.status_code, headers=headers, content=body, request=request
+        )
 
-        # Fetch each lecture
-        console.print("[bold]Fetching lecture data...[/bold]")
-        with Progress() as progress:
-            task = progress.add_task("Lectures", total=len(all_lectures))
-            tasks = [
-                fetch_lecture(client, codigo, nome, timeout, progress, task)
-                for codigo, nome in all_lectures
-            ]
-            results = await asyncio.gather(*tasks)
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+        (self.root / "index.json").write_text(json.dumps(self.index, indent=1))
+
+
+def replay_transport(root: Path, latency: float = 0) -> httpx.MockTransport:
+    """Transport serving responses saved by --record, with optional latency."""
+    index = json.loads((root / "index.json").read_text())
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        entry = index.get(str(request.url))
+        if entry is None:
+            return httpx.Response(404)
+        return httpx.Response(
+            entry["status"],
+            headers=entry["headers"],
+            content=(root / entry["file"]).read_bytes(),
+        )
 
-        valid = [r for r in results if r]
+    return httpx.MockTransport(handler)
 
-        # Save combined db.json
-        (output_dir / "db.json").write_text(json.dumps(valid, ensure_ascii=False))
-        console.print(f"[green]Saved {len(valid)} lectures to db.json[/green]")
 
+def make_transport(
+    concurrency: int,
+    retries: int,
+    record: Path | None = None,
+    replay: Path | None = None,
+    replay_latency: float = 0,
+) -> AdaptiveTransport:
+    """Pooled keep-alive transport, over HTTP/2 where JupiterWeb offers it.
 
-async def scrape_courses(
-    output_dir: Path, units: list[str] | None, concurrency: int, timeout: int
-):
-    """Scrape all courses."""
-    global unit_codes, semaphore
-    semaphore = asyncio.Semaphore(concurrency)
+    With `replay` nothing touches the network: responses come from a
+    recording made with `record`.
+    """
+    if replay:
+        inner = replay_transport(replay, replay_latency)
+    else:
+        inner = httpx.AsyncHTTPTransport(
+            verify=False,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=concurrency,
+                max_keepalive_connections=concurrency,
+                keepalive_expiry=30,
+            ),
+        )
+        if record:
+            inner = RecordingTransport(inner, record)
+    return AdaptiveTransport(inner, AdaptiveLimiter(concurrency), retries)
 
-    output_dir.mkdir(parents=True, exist_ok=True)
 
-    async with httpx.AsyncClient(
-        headers={"User-Agent": "MatrUSPbot/2.0 (+https://github.com/matrusp/matrusp)"},
-        verify=False,
+def make_client(transport: httpx.AsyncBaseTransport) -> httpx.AsyncClient:
+    """Client for JupiterWeb going through the given transport."""
+    return httpx.AsyncClient(
+        headers={"User-Agent": USER_AGENT},
+        transport=transport,
         follow_redirects=True,
-    ) as client:
-        # Fetch units
-        console.print("[bold]Fetching teaching units...[/bold]")
-        unit_codes = await fetch_units(client)
-        console.print(f"Found {len(unit_codes)} units")
+    )
 
-        # Filter units
-        target_units = units or list(unit_codes.values())
 
-        # Fetch course list
-        console.print("[bold]Fetching course list...[/bold]")
-        all_courses: list[tuple[str, str]] = []
+# ============================================
+# Page Cache
+# ============================================
 
-        with Progress() as progress:
-            task = progress.add_task("Units", total=len(target_units))
-            tasks = [fetch_unit_courses(client, code) for code in target_units]
-            results = await asyncio.gather(*tasks)
-            for courses in results:
-                all_courses.extend(courses)
-                progress.advance(task)
-
-        console.print(f"Found {len(all_courses)} courses")
-
-        # Fetch each course
-        console.print("[bold]Fetching course data...[/bold]")
-        tasks = [
-            fetch_course(client, link, period, timeout) for link, period in all_courses
-        ]
-        results = await asyncio.gather(*tasks)
 
-        valid = [r for r in results if r]
-        (output_dir / "cursos.json").write_text(json.dumps(valid, ensure_ascii=False))
-        console.print(f"[green]Saved {len(valid)} courses to cursos.json[/green]")
+class PageCache:
+    """Persistent page cache keyed by URL, with bodies stored by content hash.
+
+    Revalidates with ETag/Last-Modified when JupiterWeb sends them and falls
+    back to comparing body hashes otherwise. Parse results are memoized by
+    body hash and by a hash of this file, so a parser change is never served
+    stale results. Entries are evicted least-recently-used first once the
+    cache grows past max_bytes.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.version = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+        self.stats = {
+            "not_modified": 0,
+            "unchanged": 0,
+            "miss": 0,
+            "reparse_skipped": 0,
+        }
+        (root / "pages").mkdir(parents=True, exist_ok=True)
+        (root / "parsed").mkdir(exist_ok=True)
+        index = root / "index.json"
+        self.entries: dict[str, dict] = (
+            json.loads(index.read_text()) if index.exists() else {}
+        )
+        # Results of older code are unreachable now; save() deletes them
+        version = root / "version"
+        if not version.exists() or version.read_text() != self.version:
+            for entry in self.entries.values():
+                entry["parsed"] = {}
+
+    async def fetch(
+        self, client: httpx.AsyncClient, url: str, timeout: int
+    ) -> tuple[str, str]:
+        """Fetch a page through the cache, returning its text and hash."""
+        entry = self.entries.get(url)
+        headers = {}
+        if entry and (self.root / "pages" / entry["sha"]).exists():
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        else:
+            entry = None
+
+        resp = await get(client, url, timeout, headers)
+        if entry and resp.status_code == 304:
+            self.stats["not_modified"] += 1
+            entry["used"] = time.time()
+            path = self.root / "pages" / entry["sha"]
+            return path.read_text(encoding="utf-8"), entry["sha"]
+
+        body = resp.text.encode()
+        sha = hashlib.sha256(body).hexdigest()
+        if entry and entry["sha"] == sha:
+            self.stats["unchanged"] += 1
+        else:
+            self.stats["miss"] += 1
+            path = self.root / "pages" / sha
+            if not path.exists():
+                path.write_bytes(body)
+            entry = self.entries[url] = {"sha": sha, "size": len(body), "parsed": {}}
+
+        entry["etag"] = resp.headers.get("ETag")
+        entry["last_modified"] = resp.headers.get("Last-Modified")
+        entry["used"] = time.time()
+        return resp.text, sha
+
+    def parsed_key(self, sha: str, fn, args: tuple) -> str:
+        """Key a parse result by code version, page hash, parser function and
+        its arguments."""
+        # The backend is args[0] and does not change results (see bench.py).
+        extra = json.dumps(args[1:], sort_keys=True, ensure_ascii=False)
+        key = f"{self.version}:{fn.__name__}:{sha}:{extra}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def load_parsed(self, key: str):
+        path = self.root / "parsed" / key
+        if not path.exists():
+            return None
+        self.stats["reparse_skipped"] += 1
+        return json.loads(path.read_bytes())
+
+    def store_parsed(self, url: str, key: str, result) -> None:
+        body = json.dumps(result, ensure_ascii=False, default=json_default).encode()
+        (self.root / "parsed" / key).write_bytes(body)
+        self.entries[url]["parsed"][key] = len(body)
+
+    def save(self) -> None:
+        """Evict least-recently-used entries over the size cap, delete files
+        no entry points to, then persist."""
+        total = sum(e["size"] for e in self.entries.values())
+        total += sum(sum(e["parsed"].values()) for e in self.entries.values())
+
+        for url, entry in sorted(self.entries.items(), key=lambda kv: kv[1]["used"]):
+            if total <= self.max_bytes:
+                break
+            del self.entries[url]
+            total -= entry["size"] + sum(entry["parsed"].values())
+
+        # Bodies are shared by hash, and a changed page leaves its old body
+        # and parse results behind, so sweep by what the entries reference
+        kept = {e["sha"] for e in self.entries.values()}
+        for path in (self.root / "pages").iterdir():
+            if path.name not in kept:
+                path.unlink()
+        parsed = {key for e in self.entries.values() for key in e["parsed"]}
+        for path in (self.root / "parsed").iterdir():
+            if path.name not in parsed:
+                path.unlink()
+
+        tmp = self.root / "index.json.tmp"
+        tmp.write_text(json.dumps(self.entries))
+        tmp.replace(self.root / "index.json")
+        (self.root / "version").write_text(self.version)
+
+    def summary(self) -> str:
+        s = self.stats
+        hits = s["not_modified"] + s["unchanged"]
+        return (
+            f"Cache: {hits} hits ({s['not_modified']} not modified, "
+            f"{s['unchanged']} same hash), {s['miss']} misses, "
+            f"{s['reparse_skipped']} parses skipped"
+        )
 
 
-def main():
-    import argparse
+# ============================================
+# Metadata Store
+# ============================================
 
-    parser = argparse.ArgumentParser(description="MatrUSP JupiterWeb Scraper")
-    parser.add_argument("output_dir", type=Path, help="Output directory for JSON files")
-    parser.add_argument(
-        "--units", "-u", nargs="+", help="Specific unit codes to scrape"
-    )
-    parser.add_argument(
-        "--concurrency", "-c", type=int, default=50, help="Max concurrent requests"
-    )
-    parser.add_argument(
-        "--timeout", "-t", type=int, default=60, help="Request timeout in seconds"
-    )
-    parser.add_argument(
-        "--cursos", action="store_true", help="Scrape courses instead of lectures"
-    )
 
-    args = parser.parse_args()
+class MetadataStore:
+    """Slow-changing metadata kept between runs, by kind and key.
 
-    start = time.perf_counter()
+    Holds each discipline's obterDisciplina info (unit, department, name,
+    credits), keyed by codigo. Entries expire after `ttl` seconds, staggered
+    per key so a store filled in one run is not refreshed all at once;
+    `refresh` ignores every stored entry.
+    """
 
-    if args.cursos:
-        asyncio.run(
-            scrape_courses(args.output_dir, args.units, args.concurrency, args.timeout)
-        )
-    else:
-        asyncio.run(
-            scrape_lectures(args.output_dir, args.units, args.concurrency, args.timeout)
+    def __init__(self, path: Path, ttl: float, refresh: bool = False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.stats = {"reused": 0, "fetched": 0}
+        self.data: dict[str, dict[str, dict]] = (
+            json.loads(path.read_text()) if path.exists() else {}
         )
 
+    def get(self, kind: str, key: str):
+        entry = self.data.get(kind, {}).get(key)
+        if entry is None or self.refresh:
+            return None
+        # Spread expiry over the last quarter of the TTL
+        ttl = self.ttl * (0.75 + 0.25 * (zlib.crc32(key.encode()) % 1000) / 1000)
+        if time.time() - entry["at"] > ttl:
+            return None
+        self.stats["reused"] += 1
+        return entry["value"]
+
+    def put(self, kind: str, key: str, value) -> None:
+        self.stats["fetched"] += 1
+        self.data.setdefault(kind, {})[key] = {"at": time.time(), "value": value}
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(self.data, ensure_ascii=False))
+        tmp.replace(self.path)
+
+    def summary(self) -> str:
+        return (
+            f"Metadata: {self.stats['reused']} reused, {self.stats['fetched']} fetched"
+        )
+
+
+# ============================================
+# Checkpoint Journal
+# ============================================
+
+
+class Journal:
+    """Append-only JSONL record of finished items, so a run can be resumed.
+
+    Each line is `[pipeline, key, result]`, flushed as soon as the item is
+    parsed; result is null for items that produced nothing. With `resume`,
+    earlier lines are indexed by offset (results stay on disk until needed)
+    and a torn last line from a killed run is dropped; otherwise the journal
+    starts empty, with a warning when that discards an earlier run's.
+    """
+
+    def __init__(self, path: Path, resume: bool = False):
+        self.path = path
+        self.offsets: dict[tuple[str, str], tuple[int, int]] = {}
+        self.resumed = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if resume and path.exists():
+            self._index()
+            self.file = open(path, "ab")
+        else:
+            if path.exists() and path.stat().st_size:
+                console.print(
+                    f"[yellow]Starting {path} over, discarding an unfinished "
+                    "run's items; --resume would keep them[/yellow]"
+                )
+            self.file = open(path, "wb")
+
+    def _index(self) -> None:
+        end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    pipeline, key, _ = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                self.offsets[pipeline, key] = (end, len(line))
+                end += len(line)
+        os.truncate(self.path, end)
+
+    def pending(self, pipeline: str, items: list[tuple], done) -> list[tuple]:
+        """Pass journaled results of items to done; return the other items."""
+        if not self.offsets:
+            return items
+        rest = []
+        with open(self.path, "rb") as f:
+            for item in items:
+                entry = self.offsets.get((pipeline, item[0]))
+                if entry is None:
+                    rest.append(item)
+                    continue
+                f.seek(entry[0])
+                result = json.loads(f.read(entry[1]))[2]
+                if result:
+                    done(result)
+                self.resumed += 1
+        return rest
+
+    def record(self, pipeline: str, key: str, result) -> None:
+        line = json.dumps(
+            [pipeline, key, result], ensure_ascii=False, default=json_default
+        )
+        self.file.write(line.encode() + b"\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def clear(self) -> None:
+        """Drop the journal once a run has nothing left to resume."""
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+
+# ============================================
+# Output
+# ============================================
+
+
+class JsonArrayWriter:
+    """Stream a JSON array to disk one item at a time.
+
+    Items go to a temporary file that atomically replaces `path` on success,
+    so memory does not grow with the number of items and a failed run never
+    leaves a truncated file behind. The bytes match json.dumps(items).
+
+    With sort_key, items are spooled unsorted and written out in key order at
+    the end, keeping only their keys and offsets in memory.
+    """
+
+    def __init__(self, path: Path, sort_key: str | None = None):
+        self.path = path
+        self.sort_key = sort_key
+        self.count = 0
+        self.tmp = path.with_name(path.name + ".tmp")
+        self.spool = path.with_name(path.name + ".spool") if sort_key else None
+        self.offsets: list[tuple[str, int, int, int]] = []  # key, seq, start, size
+
+    def __enter__(self) -> "JsonArrayWriter":
+        self.file = open(self.spool or self.tmp, "wb")
+        if not self.spool:
+            self.file.write(b"[")
+        return self
+
+    def write(self, item: dict) -> None:
+        start = time.perf_counter()
+        data = json.dumps(item, ensure_ascii=False, default=json_default).encode()
+        metrics.stages["json_encode"] += time.perf_counter() - start
+        if self.spool:
+            key = item.get(self.sort_key) or ""
+            self.offsets.append((key, self.count, self.file.tell(), len(data)))
+        elif self.count:
+            self.file.write(b", ")
+        self.file.write(data)
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.file.close()
+        if exc_type is not None:
+            self.tmp.unlink(missing_ok=True)
+            if self.spool:
+                self.spool.unlink(missing_ok=True)
+            return
+
+        with metrics.stage("write_output"):
+            self._finish()
+
+    def _finish(self) -> None:
+        if self.spool:
+            self.offsets.sort()
+            with open(self.spool, "rb") as src, open(self.tmp, "wb") as out:
+                out.write(b"[")
+                for i, (_, _, start, size) in enumerate(self.offsets):
+                    if i:
+                        out.write(b", ")
+                    src.seek(start)
+                    out.write(src.read(size))
+                out.write(b"]")
+            self.spool.unlink()
+        else:
+            with open(self.tmp, "ab") as out:
+                out.write(b"]")
+
+        self.tmp.replace(self.path)
+
+
+def iter_json_array(path: Path, chunk_size: int = 1 << 20):
+    """Yield the objects of a JSON array file without loading it whole."""
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer = f.read(chunk_size)
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} is not a JSON array")
+        pos = 1
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                buffer, pos = f.read(chunk_size), 0
+                if not buffer:
+                    raise ValueError(f"{path} ends before its array does")
+                continue
+            if buffer[pos] == "]":
+                return
+            # Items are objects, so a truncated one never decodes
+            while True:
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                    break
+                except json.JSONDecodeError:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        raise
+                    buffer, pos = buffer[pos:] + chunk, 0
+            yield item
+
+
+# Fields identifying an item of each output file
+ITEM_KEYS = {"db.json": ("codigo",), "cursos.json": ("codigo", "periodo")}
+
+# Files listed in manifest.json and precompressed
+OUTPUT_FILES = (
+    "campi.json",
+    *ITEM_KEYS,
+    "search.json",
+    "horarios.json",
+    "requisitos.json",
+    "vagas.json",
+)
+
+
+def item_key(item: dict, fields: tuple[str, ...]) -> tuple:
+    return tuple(item.get(field) for field in fields)
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Versioned manifest.json of the output files, with a delta per version.
+
+    Created before a run, it indexes the previous db.json and cursos.json as
+    item key -> content hash, so only keys and hashes are held in memory.
+    update() then streams the new files against that index and, if anything
+    changed, bumps the version. When db.json or cursos.json changed, it also
+    writes `deltas/<version>.json` with the items added, changed and removed
+    (by key) since `items_version`, the last version where they changed; it
+    applies to any version from there on. Other files are listed by hash
+    only, for clients to fetch whole. The last `keep` deltas are listed;
+    older ones are deleted.
+    """
+
+    def __init__(self, output_dir: Path, keep: int = 12):
+        self.output_dir = output_dir
+        self.keep = keep
+        self.path = output_dir / "manifest.json"
+        self.data = (
+            json.loads(self.path.read_text())
+            if self.path.exists()
+            else {"version": 0, "files": {}, "deltas": []}
+        )
+        self.previous: dict[str, dict[tuple, bytes]] = {}
+        for name, fields in ITEM_KEYS.items():
+            path = output_dir / name
+            if path.exists():
+                self.previous[name] = {
+                    item_key(item, fields): self._hash(item)
+                    for item in iter_json_array(path)
+                }
+
+    @staticmethod
+    def _hash(item: dict) -> bytes:
+        data = json.dumps(item, ensure_ascii=False, sort_keys=True).encode()
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def update(self) -> None:
+        files = {}
+        for name in OUTPUT_FILES:
+            path = self.output_dir / name
+            if path.exists():
+                files[name] = {
+                    "sha256": file_sha256(path),
+                    "bytes": path.stat().st_size,
+                }
+        changed = [
+            name
+            for name in files
+            if files[name]["sha256"] != self.data["files"].get(name, {}).get("sha256")
+        ]
+        if not changed:
+            console.print(f"Manifest: no changes, still version {self.data['version']}")
+            return
+
+        version = self.data["version"] + 1
+        since = self.data.get("items_version", self.data["version"])
+        items_changed = [name for name in changed if name in ITEM_KEYS]
+        # A delta needs something to apply to, and something to say: a run
+        # that only changed vagas.json or the indexes adds none
+        if items_changed and self.data["version"] and self.previous:
+            delta = self.output_dir / "deltas" / f"{version}.json"
+            self._write_delta(delta, since, version, items_changed)
+            self.data["deltas"].append(
+                {
+                    "from": since,
+                    "to": version,
+                    "path": f"deltas/{delta.name}",
+                    "bytes": delta.stat().st_size,
+                }
+            )
+        if items_changed:
+            self.data["items_version"] = version
+        for old in self.data["deltas"][: -self.keep]:
+            (self.output_dir / old["path"]).unlink(missing_ok=True)
+        self.data["deltas"] = self.data["deltas"][-self.keep :]
+        self.data["version"] = version
+        self.data["files"] = files
+
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(self.data, indent=2) + "\n")
+        tmp.replace(self.path)
+        console.print(f"Manifest: version {version} ({', '.join(changed)} changed)")
+
+    def _write_delta(
+        self, path: Path, since: int, version: int, names: list[str]
+    ) -> None:
+        """Stream each changed file against its previous index into path.
+
+        Changed items are spooled while added ones are written, so each file
+        is read once.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        spool = path.with_name(path.name + ".spool")
+        with open(tmp, "wb") as out:
+            out.write(f'{{"from": {since}, "to": {version}, "files": {{'.encode())
+            for i, name in enumerate(names):
+                fields = ITEM_KEYS[name]
+                previous = self.previous.get(name, {})
+                seen = set()
+                counts = {"added": 0, "changed": 0}
+                out.write(f'{", " if i else ""}"{name}": {{"added": ['.encode())
+                with open(spool, "w+b") as changed:
+                    for item in iter_json_array(self.output_dir / name):
+                        key = item_key(item, fields)
+                        seen.add(key)
+                        old = previous.get(key)
+                        if old == self._hash(item):
+                            continue
+                        kind, f = ("changed", changed) if old else ("added", out)
+                        data = json.dumps(item, ensure_ascii=False).encode()
+                        f.write((b", " if counts[kind] else b"") + data)
+                        counts[kind] += 1
+                    out.write(b'], "changed": [')
+                    changed.seek(0)
+                    while chunk := changed.read(1 << 20):
+                        out.write(chunk)
+                removed = [
+                    dict(zip(fields, key)) for key in previous if key not in seen
+                ]
+                out.write(b'], "removed": ')
+                out.write(json.dumps(removed, ensure_ascii=False).encode())
+                out.write(b"}")
+                console.print(
+                    f"Delta {name}: {counts['added']} added, "
+                    f"{counts['changed']} changed, {len(removed)} removed"
+                )
+            out.write(b"}}")
+        spool.unlink(missing_ok=True)
+        tmp.replace(path)
+
+
+# ============================================
+# Vacancy History
+# ============================================
+
+# Rows are only added for keys whose value differs from the latest stored
+# one; NULL values mark a classroom or group that disappeared.
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    time TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vacancies (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    codigo TEXT NOT NULL,
+    turma TEXT NOT NULL,
+    tipo TEXT NOT NULL,
+    grupo TEXT NOT NULL,
+    vagas INTEGER,
+    inscritos INTEGER,
+    pendentes INTEGER,
+    matriculados INTEGER
+);
+CREATE INDEX IF NOT EXISTS vacancies_key ON vacancies (codigo, turma, tipo, grupo);
+CREATE TABLE IF NOT EXISTS schedules (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    codigo TEXT NOT NULL,
+    turma TEXT NOT NULL,
+    horario TEXT
+);
+CREATE INDEX IF NOT EXISTS schedules_key ON schedules (codigo, turma);
+"""
+
+VACANCY_KEY = ("codigo", "turma", "tipo", "grupo")
+VACANCY_COUNTS = ("vagas", "inscritos", "pendentes", "matriculados")
+
+
+def vacancy_rows(codigo: str, turma: dict):
+    """(key, counts) per vacancy type of a classroom and per group of each;
+    a type's totals have grupo ""."""
+    for tipo, vacancy in turma["vagas"].items():
+        yield (
+            (codigo, turma["codigo"], tipo, ""),
+            tuple(map(vacancy.get, VACANCY_COUNTS)),
+        )
+        for grupo, counts in vacancy.get("grupos", {}).items():
+            yield (
+                (codigo, turma["codigo"], tipo, grupo),
+                tuple(map(counts.get, VACANCY_COUNTS)),
+            )
+
+
+class ChangeReport:
+    """What changed in a VacancyHistory.record() run."""
+
+    def __init__(self, previous: tuple[int, str] | None):
+        self.previous = previous  # (run id, time) compared against
+        self.lectures = 0
+        self.turmas = 0
+        self.lectures_added: list[str] = []
+        self.lectures_removed: list[str] = []
+        self.turmas_added: list[tuple[str, str]] = []
+        self.turmas_removed: list[tuple[str, str]] = []
+        self.schedules_changed: list[tuple[str, str]] = []
+        # (key, old counts, new counts) of the vacancy rows in both runs
+        self.vacancies_changed: list[tuple[tuple, tuple, tuple]] = []
+
+    def summary(self) -> str:
+        if not self.previous:
+            return (
+                f"History: first run, {self.lectures} lectures and "
+                f"{self.turmas} classrooms recorded"
+            )
+        return (
+            f"History: {len(self.lectures_added)} lectures added, "
+            f"{len(self.lectures_removed)} removed; {len(self.turmas_added)} "
+            f"classrooms added, {len(self.turmas_removed)} removed, "
+            f"{len(self.schedules_changed)} with new schedules; "
+            f"{len(self.vacancies_changed)} vacancy counts changed"
+        )
+
+    def markdown(self, limit: int = 20) -> str:
+        """Render the report for the GitHub step summary, listing at most
+        `limit` items of each kind."""
+        if not self.previous:
+            return f"### Changes\n\n{self.summary()[len('History: ') :]}.\n"
+
+        def codes(items: list) -> str:
+            shown = ", ".join(
+                f"`{item if isinstance(item, str) else '/'.join(item)}`"
+                for item in items[:limit]
+            )
+            if len(items) > limit:
+                shown += f" and {len(items) - limit} more"
+            return shown
+
+        lines = [
+            f"### Changes since run {self.previous[0]} ({self.previous[1]})",
+            "",
+            "| | Added | Removed | Changed |",
+            "| --- | ---: | ---: | ---: |",
+            f"| Lectures | {len(self.lectures_added)} | "
+            f"{len(self.lectures_removed)} | |",
+            f"| Classrooms | {len(self.turmas_added)} | {len(self.turmas_removed)} | "
+            f"{len(self.schedules_changed)} schedules |",
+            f"| Vacancy counts | | | {len(self.vacancies_changed)} |",
+            "",
+        ]
+        for title, items in (
+            ("Added lectures", self.lectures_added),
+            ("Removed lectures", self.lectures_removed),
+            ("Added classrooms", self.turmas_added),
+            ("Removed classrooms", self.turmas_removed),
+            ("New schedules", self.schedules_changed),
+        ):
+            if items:
+                lines += [f"**{title}:** {codes(items)}", ""]
+
+        # Largest changes in inscritos plus matriculados, totals per type only
+        totals = [change for change in self.vacancies_changed if change[0][3] == ""]
+        totals.sort(
+            key=lambda c: abs(c[2][1] - c[1][1]) + abs(c[2][3] - c[1][3]),
+            reverse=True,
+        )
+        if totals:
+            lines += [
+                "| Classroom | Type | Vagas | Inscritos | Matriculados |",
+                "| --- | --- | ---: | ---: | ---: |",
+            ]
+            for (codigo, turma, tipo, _), old, new in totals[:limit]:
+                cells = [
+                    f"{old[i]} → {new[i]}" if old[i] != new[i] else str(new[i])
+                    for i in (0, 1, 3)
+                ]
+                lines.append(f"| {codigo}/{turma} | {tipo} | {' | '.join(cells)} |")
+            lines.append("")
+        return "\n".join(lines)
+
+
+class VacancyHistory:
+    """Append-only SQLite time series of classroom vacancies and schedules.
+
+    record() streams db.json lectures against the latest stored state and,
+    in one transaction, adds a run and a row for every classroom vacancy
+    count (per type and group) and schedule that changed since the previous
+    run. Values at any run are the latest rows at or before it.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(HISTORY_SCHEMA)
+
+    def _latest(self, table: str, key: tuple, values: tuple) -> dict[tuple, tuple]:
+        """Latest values per key, leaving out keys that disappeared."""
+        columns = ", ".join(key)
+        rows = self.db.execute(
+            f"SELECT {columns}, {', '.join(values)} FROM {table} "
+            f"WHERE rowid IN (SELECT MAX(rowid) FROM {table} GROUP BY {columns})"
+        )
+        n = len(key)
+        return {row[:n]: row[n:] for row in rows if row[n] is not None}
+
+    def record(
+        self,
+        lectures: Iterable[dict],
+        with_schedules: bool = True,
+        covered: set[str] | None = None,
+    ) -> ChangeReport:
+        """Without schedules (classrooms from vagas.json), only vacancies are
+        compared, and lectures and classrooms are not reported as added or
+        removed. With `covered`, only keys of those lectures can be removed;
+        the others are left as they were."""
+        vacancies = self._latest("vacancies", VACANCY_KEY, VACANCY_COUNTS)
+        schedules = (
+            self._latest("schedules", ("codigo", "turma"), ("horario",))
+            if with_schedules
+            else {}
+        )
+        report = ChangeReport(
+            self.db.execute(
+                "SELECT id, time FROM runs ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+        )
+        known = {codigo for codigo, _ in schedules}
+        codigos = set()
+        seen = set()
+        vacancy_rows_new = []
+        schedule_rows = []
+
+        for lecture in lectures:
+            codigo = lecture["codigo"]
+            # Lectures listed under several units come more than once
+            if codigo in codigos:
+                continue
+            codigos.add(codigo)
+            if with_schedules and report.previous and codigo not in known:
+                report.lectures_added.append(codigo)
+            for turma in lecture["turmas"]:
+                key = (codigo, turma["codigo"])
+                if key in seen:
+                    continue
+                seen.add(key)
+                if with_schedules:
+                    horario = json.dumps(
+                        turma["horario"], ensure_ascii=False, separators=(",", ":")
+                    )
+                    old = schedules.pop(key, None)
+                    if old != (horario,):
+                        schedule_rows.append((*key, horario))
+                        if old:
+                            report.schedules_changed.append(key)
+                        elif report.previous and codigo in known:
+                            report.turmas_added.append(key)
+                for vacancy_key, counts in vacancy_rows(codigo, turma):
+                    old = vacancies.pop(vacancy_key, None)
+                    if old != counts:
+                        vacancy_rows_new.append((*vacancy_key, *counts))
+                        if old:
+                            report.vacancies_changed.append((vacancy_key, old, counts))
+
+        report.lectures = len(codigos)
+        report.turmas = len(seen)
+        if covered is not None:
+            known &= covered
+            schedules = {key: v for key, v in schedules.items() if key[0] in covered}
+            vacancies = {key: v for key, v in vacancies.items() if key[0] in covered}
+        report.lectures_removed = sorted(known - codigos)
+        for key in schedules:
+            schedule_rows.append((*key, None))
+            if key[0] in codigos:
+                report.turmas_removed.append(key)
+        for key in vacancies:
+            vacancy_rows_new.append((*key, None, None, None, None))
+
+        with self.db:
+            run = self.db.execute(
+                "INSERT INTO runs (time) VALUES (?)",
+                (time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),),
+            ).lastrowid
+            self.db.executemany(
+                "INSERT INTO schedules VALUES (?, ?, ?, ?)",
+                ((run, *row) for row in schedule_rows),
+            )
+            self.db.executemany(
+                "INSERT INTO vacancies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((run, *row) for row in vacancy_rows_new),
+            )
+        return report
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def history_skip_reason(runs: list[dict]) -> str | None:
+    """Why the output of these runs must not be recorded, or None.
+
+    `runs` holds the metrics of a run, or of each merged shard. record()
+    reads every stored lecture missing from the output as removed, so only
+    runs that together scraped every unit and shard with no lecture failing
+    are recorded.
+    """
+    shards = set()
+    for run in runs:
+        scope = run.get("scope", {})
+        if scope.get("units"):
+            return "limited to some units"
+        if any(key.startswith("lecture ") for key in run.get("failed", {})):
+            return "some lectures failed"
+        shards.add(tuple(scope.get("shard") or (1, 1)))
+    counts = {count for _, count in shards}
+    if len(counts) != 1 or shards != {(i, *counts) for i in range(1, max(counts) + 1)}:
+        return "not every shard was merged"
+    return None
+
+
+def record_history(
+    path: Path,
+    lectures: Iterable[dict],
+    with_schedules: bool = True,
+    covered: set[str] | None = None,
+) -> ChangeReport:
+    """Add lectures to the vacancy history at path and report the changes."""
+    history = VacancyHistory(path)
+    try:
+        report = history.record(lectures, with_schedules, covered)
+    finally:
+        history.close()
+    console.print(report.summary())
+    step_summary(report.markdown())
+    return report
+
+
+# ============================================
+# Search Index
+# ============================================
+
+# Ports of normalizeText, generateTrigrams and the timeframe and units
+# indexing in src/lib/services/database.ts; any change there must be made
+# here too. JS regex classes are spelled out where Python's differ.
+
+STOPWORDS = {
+    "DE", "DA", "DO", "DAS", "DOS", "A", "EM", "NO", "NA", "NOS", "NAS",
+    "E", "O", "AO", "AS", "OS", "AOS", "PARA", "POR",
+}  # fmt: skip
+
+JS_SPACE = "[\t\n\v\f\r \u00a0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000\ufeff]"
+RE_COMBINING = re.compile("[\u0300-\u036f]")
+RE_ROMAN_SPACE = re.compile(f"((?<![A-Za-z0-9_])[IVXLCM]+){JS_SPACE}+(?=[IVXLCM])")
+RE_SPACES = re.compile(f"{JS_SPACE}+")
+RE_NUMBER = re.compile("[0-9]+")
+RE_LEADING_INT = re.compile(f"{JS_SPACE}*([+-]?[0-9]+)")
+
+ROMAN = (
+    ("M", 1000), ("CM", 900), ("D", 500), ("CD", 400), ("C", 100), ("XC", 90),
+    ("L", 50), ("XL", 40), ("X", 10), ("IX", 9), ("V", 5), ("IV", 4), ("I", 1),
+)  # fmt: skip
+
+# Bit of each timeframe in search.json's periodos flags
+PERIODOS = ("matutino", "vespertino", "noturno")
+
+
+def normalize_text(text: str) -> str:
+    """Remove accents and convert to uppercase."""
+    return RE_COMBINING.sub("", unicodedata.normalize("NFD", text.upper()))
+
+
+def romanize(num: int) -> str:
+    roman = ""
+    for symbol, value in ROMAN:
+        while num >= value:
+            roman += symbol
+            num -= value
+    return roman
+
+
+def generate_trigrams(text: str) -> list[str]:
+    """Trigrams of a lecture name or code, as indexed by the client."""
+    trigrams = []
+    text = RE_ROMAN_SPACE.sub(r"\1", normalize_text(text))
+    words = RE_SPACES.split(text)
+
+    # Trailing numbers become Roman numerals ("Calculo 2" -> "Calculo II")
+    if len(words) > 1 and RE_NUMBER.fullmatch(words[-1]):
+        words[-1] = romanize(int(words[-1]))
+
+    words = [w for i, w in enumerate(words) if w and (i == 0 or w not in STOPWORDS)]
+
+    for i, word in enumerate(words):
+        trigrams.append(f"{word[0]}#")
+        if i == 0 and len(word) > 2:
+            trigrams.append(f"{word[:3]}!")
+        trigrams.append(f"{word}$")
+        for j in range(len(word) - 2):
+            trigrams.append(word[j : j + 3])
+        if i > 0:
+            trigrams.append(f"{words[i - 1][0]}{word[0]}%")
+
+    return trigrams
+
+
+def js_parse_int(text: str) -> int | None:
+    """parseInt(text, 10), with None for NaN."""
+    match = RE_LEADING_INT.match(text)
+    return int(match.group(1)) if match else None
+
+
+def lecture_periodos(lecture: dict) -> int:
+    """Flags of the timeframes (PERIODOS) a lecture has classes in."""
+    flags = 0
+    for classroom in lecture.get("turmas") or []:
+        for schedule in classroom.get("horario") or []:
+            start = js_parse_int(schedule["inicio"][:2])
+            end = js_parse_int(schedule["fim"][:2])
+            # Comparisons with NaN are false
+            if start is not None and start < 12:
+                flags |= 1
+            elif start is not None and start < 18:
+                flags |= 2
+            else:
+                flags |= 4
+            if end is not None and end > 19:
+                flags |= 4
+            elif end is not None and end > 13:
+                flags |= 2
+            else:
+                flags |= 1
+    return flags
+
+
+def write_search_index(db_path: Path, path: Path) -> None:
+    """Precompute the client's search index from db.json into path.
+
+    Writes `codes` (each lecture codigo once), `trigrams` (for each trigram,
+    the index in `codes` of every lecture it occurs in, once per
+    occurrence), `trigramCount` (occurrences in total), `units` (unit ->
+    departments, in first-seen order) and `periodos` (PERIODOS flags per
+    code). The client derives its scores as
+    `Math.sqrt(Math.log(trigramCount / docCount)) * Math.log(1 + count)`, so
+    they are bit-for-bit what it would compute from db.json itself.
+    """
+    codes: dict[str, int] = {}
+    postings: dict[str, list[int]] = defaultdict(list)
+    trigram_count = 0
+    units: dict[str, dict] = {}
+    periodos: list[int] = []
+
+    for lecture in iter_json_array(db_path):
+        codigo = lecture["codigo"]
+        if codigo not in codes:
+            codes[codigo] = len(codes)
+            periodos.append(0)
+        index = codes[codigo]
+        # Later duplicates replace earlier ones, as with bulkPut
+        periodos[index] = lecture_periodos(lecture)
+
+        for trigram in generate_trigrams(lecture["nome"]) + generate_trigrams(codigo):
+            postings[trigram].append(index)
+            trigram_count += 1
+
+        # A missing unit or department is still indexed, as in JS
+        unit = lecture.get("unidade", "undefined")
+        units.setdefault(unit, {})[lecture.get("departamento")] = None
+
+    index = {
+        "trigramCount": trigram_count,
+        "codes": list(codes),
+        "trigrams": {t: sorted(postings[t]) for t in sorted(postings)},
+        "units": {unit: list(departments) for unit, departments in units.items()},
+        "periodos": periodos,
+    }
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")))
+    tmp.replace(path)
+    console.print(
+        f"[green]Saved search index of {len(codes)} lectures and "
+        f"{len(postings)} trigrams to {path.name}[/green]"
+    )
+
+
+# ============================================
+# Schedule Index
+# ============================================
+
+# Ports of parseTime (src/lib/models/types.ts) and classroomsConflict
+# (src/lib/services/combination.ts); any change there must be made here too.
+# Weekly masks have bit `day * SLOTS_PER_DAY + slot` set for each 5-minute
+# slot a classroom meets in, with days in DAYS_ORDERED order.
+
+DAYS = ("seg", "ter", "qua", "qui", "sex", "sab", "dom")
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+MASK_WORD_BITS = 32
+
+
+def parse_minutes(text: str) -> int | None:
+    """Minutes since midnight of "H:MM", or None where parseTime gives NaN."""
+    hours, _, minutes = text.partition(":")
+    try:
+        return int(hours) * 60 + int(minutes)
+    except ValueError:
+        return None
+
+
+def parse_day(text: str) -> tuple[int, int, int] | None:
+    """(year, month, day) of "DD/MM/YYYY", or None where parseDate is NaN."""
+    try:
+        day, month, year = map(int, text.split("/"))
+    except ValueError:
+        return None
+    return year, month, day
+
+
+def schedule_ranges(horario: list[dict]) -> list[tuple[int, int, int]]:
+    """Each time slot as (day index, start minute, end minute); slots with an
+    unknown day or an invalid time never conflict, and are left out."""
+    ranges = []
+    for slot in horario:
+        start, end = parse_minutes(slot["inicio"]), parse_minutes(slot["fim"])
+        if slot["dia"] in DAYS and start is not None and end is not None:
+            ranges.append((DAYS.index(slot["dia"]), start, end))
+    return ranges
+
+
+def weekly_mask(ranges: list[tuple[int, int, int]]) -> int:
+    """Mask of the slots touched by ranges. Exact for times on 5-minute
+    boundaries; otherwise partly covered slots are set too, so disjoint
+    masks never hide a conflict between ranges that end after they start."""
+    mask = 0
+    for day, start, end in ranges:
+        first = max(start, 0) // SLOT_MINUTES
+        last = min(-(-end // SLOT_MINUTES), SLOTS_PER_DAY)
+        if last > first:
+            mask |= ((1 << (last - first)) - 1) << (day * SLOTS_PER_DAY + first)
+    return mask
+
+
+def mask_words(mask: int) -> list[int]:
+    """The nonzero 32-bit words of mask, as a flat [index, word, ...] list."""
+    words = []
+    index = 0
+    while mask:
+        if word := mask & 0xFFFFFFFF:
+            words += [index, word]
+        mask >>= MASK_WORD_BITS
+        index += 1
+    return words
+
+
+def classrooms_conflict(a: tuple, b: tuple) -> bool:
+    """classroomsConflict for two (turma, ranges) pairs. Masks are not used,
+    as an inverted range (end before start) can still overlap there."""
+    t1, ranges1 = a
+    t2, ranges2 = b
+    if not t1.get("horario") or not t2.get("horario"):
+        return False
+    dates = [t1.get("inicio"), t1.get("fim"), t2.get("inicio"), t2.get("fim")]
+    if all(dates):
+        start1, end1, start2, end2 = map(parse_day, dates)
+        if None in (start1, end1, start2, end2):
+            return False
+        if not (start1 < end2 and end1 > start2):
+            return False
+    return any(
+        day1 == day2 and s1 < e2 and e1 > s2
+        for day1, s1, e1 in ranges1
+        for day2, s2, e2 in ranges2
+    )
+
+
+def lecture_schedule(lecture: dict) -> dict:
+    """Minute ranges, weekly masks and conflicts of a lecture's turmas."""
+    turmas = [
+        (turma, schedule_ranges(turma.get("horario") or []))
+        for turma in lecture["turmas"]
+    ]
+    conflicts: list[list[int]] = [[] for _ in turmas]
+    for i, a in enumerate(turmas):
+        for j in range(i + 1, len(turmas)):
+            if classrooms_conflict(a, turmas[j]):
+                conflicts[i].append(j)
+                conflicts[j].append(i)
+    return {
+        "turmas": [turma["codigo"] for turma, _ in turmas],
+        "horarios": [[list(r) for r in ranges] for _, ranges in turmas],
+        "mascaras": [mask_words(weekly_mask(ranges)) for _, ranges in turmas],
+        "conflitos": conflicts,
+    }
+
+
+def write_schedule_index(db_path: Path, path: Path) -> None:
+    """Precompute each lecture's turma schedules and conflicts into path.
+
+    For every lecture codigo, `turmas` lists its turma codes in db.json
+    order, and the other arrays follow it: `horarios` the time slots as
+    [day, start, end] (day index into `dias`, minutes since midnight),
+    `mascaras` the weekly masks as [word index, 32-bit word, ...] and
+    `conflitos` the indices of the turmas each one conflicts with, as
+    classroomsConflict decides (same day, overlapping times and dates).
+    """
+    lectures: dict[str, dict] = {}
+    for lecture in iter_json_array(db_path):
+        # Later duplicates replace earlier ones, as with bulkPut
+        lectures[lecture["codigo"]] = lecture_schedule(lecture)
+
+    index = {
+        "dias": DAYS,
+        "slotMinutes": SLOT_MINUTES,
+        "slotsPerDay": SLOTS_PER_DAY,
+        "disciplinas": lectures,
+    }
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")))
+    tmp.replace(path)
+    pairs = sum(len(c) for entry in lectures.values() for c in entry["conflitos"])
+    console.print(
+        f"[green]Saved schedules of {len(lectures)} lectures to {path.name} "
+        f"({pairs // 2} conflicting turma pairs)[/green]"
+    )
+
+
+# ============================================
+# Requirements Index
+# ============================================
+
+# Requirement kinds in cursos.json entries -> key in requisitos.json. Strong
+# and weak requirements order lectures; indicações de conjunto do not.
+REQUIREMENT_KINDS = {
+    "req_forte": "forte",
+    "req_fraco": "fraco",
+    "ind_conjunto": "conjunto",
+}
+ORDERING_KINDS = ("forte", "fraco")
+
+
+def requirement_layers(requisitos: list[set[int]]) -> list[int]:
+    """Topological layer of each lecture: 0 without requirements, else one
+    more than its deepest requirement; -1 on or after a cycle."""
+    layers = [-1] * len(requisitos)
+    waiting = [len(reqs) for reqs in requisitos]
+    unlocks: list[list[int]] = [[] for _ in requisitos]
+    for lecture, reqs in enumerate(requisitos):
+        for req in reqs:
+            unlocks[req].append(lecture)
+    ready = [lecture for lecture, count in enumerate(waiting) if not count]
+    for lecture in ready:
+        layers[lecture] = 0
+    # Kahn's algorithm; `ready` grows while it is walked
+    for lecture in ready:
+        for after in unlocks[lecture]:
+            layers[after] = max(layers[after], layers[lecture] + 1)
+            waiting[after] -= 1
+            if not waiting[after]:
+                ready.append(after)
+    for lecture, count in enumerate(waiting):
+        if count:
+            layers[lecture] = -1
+    return layers
+
+
+def requirement_closure(requisitos: list[set[int]]) -> list[int]:
+    """Bitset of each lecture's direct and indirect requirements. A lecture
+    on a cycle has itself in its set."""
+    closures = []
+    for lecture, reqs in enumerate(requisitos):
+        bits = 0
+        stack = list(reqs)
+        while stack:
+            req = stack.pop()
+            if not bits >> req & 1:
+                bits |= 1 << req
+                stack.extend(requisitos[req])
+        closures.append(bits)
+    return closures
+
+
+def write_requirements_index(cursos_path: Path, path: Path) -> None:
+    """Build the requirement graph of all curricula in cursos.json into path.
+
+    Every lecture code in a curriculum or a requirement gets an integer ID,
+    its index in `codigos` (in code order). Per kind (`forte`, `fraco`,
+    `conjunto`), `requisitos[kind][id]` lists the IDs it requires and
+    `liberados[kind][id]` the IDs that require it, merged over all
+    curricula. `camadas` has each lecture's topological layer over strong
+    and weak requirements (-1 on cycles) and `antecessores` all of its
+    direct and indirect strong and weak requirements, as a bitset over IDs
+    stored as its nonzero 32-bit words, `[index, word, ...]`.
+    """
+    edges: dict[str, set[tuple[str, str]]] = {
+        kind: set() for kind in REQUIREMENT_KINDS.values()
+    }
+    codes = set()
+    courses = 0
+    for course in iter_json_array(cursos_path):
+        courses += 1
+        for entries in (course.get("periodos") or {}).values():
+            for entry in entries:
+                codes.add(entry["codigo"])
+                for field, kind in REQUIREMENT_KINDS.items():
+                    for req in entry.get(field) or ():
+                        codes.add(req)
+                        edges[kind].add((req, entry["codigo"]))
+
+    codigos = sorted(codes)
+    ids = {code: i for i, code in enumerate(codigos)}
+    requisitos = {kind: [set() for _ in codigos] for kind in edges}
+    liberados = {kind: [set() for _ in codigos] for kind in edges}
+    for kind, pairs in edges.items():
+        for req, lecture in pairs:
+            requisitos[kind][ids[lecture]].add(ids[req])
+            liberados[kind][ids[req]].add(ids[lecture])
+
+    ordering = [
+        set().union(*(requisitos[kind][i] for kind in ORDERING_KINDS))
+        for i in range(len(codigos))
+    ]
+    index = {
+        "codigos": codigos,
+        "requisitos": {
+            kind: [sorted(s) for s in sets] for kind, sets in requisitos.items()
+        },
+        "liberados": {
+            kind: [sorted(s) for s in sets] for kind, sets in liberados.items()
+        },
+        "camadas": requirement_layers(ordering),
+        "antecessores": [mask_words(bits) for bits in requirement_closure(ordering)],
+    }
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")))
+    tmp.replace(path)
+    console.print(
+        f"[green]Saved requirements of {len(codigos)} lectures from {courses} "
+        f"curricula to {path.name} ({sum(map(len, edges.values()))} edges, "
+        f"{max(index['camadas'], default=-1) + 1} layers)[/green]"
+    )
+
+
+# ============================================
+# Compact Output
+# ============================================
+
+# Field kinds in compact shapes: s string, t time ("HH:MM", as minutes), i int,
+# o object, S array of strings, O array of objects, e empty array (omitted),
+# j any other JSON value
+RE_TIME = re.compile(r"([01]\d|2[0-3]):[0-5]\d")
+
+COMPACT_FORMATS = ("json", "msgpack")
+
+
+def compact_kind(value) -> str:
+    if isinstance(value, str):
+        return "t" if RE_TIME.fullmatch(value) else "s"
+    if isinstance(value, bool) or value is None:
+        return "j"
+    if isinstance(value, int):
+        return "i"
+    if isinstance(value, dict):
+        return "o"
+    if isinstance(value, list):
+        if not value:
+            return "e"
+        if all(isinstance(x, str) for x in value):
+            return "S"
+        if all(isinstance(x, dict) for x in value):
+            return "O"
+    return "j"
+
+
+def count_strings(obj: dict, counts: dict[str, int]) -> None:
+    for value in obj.values():
+        kind = compact_kind(value)
+        if kind == "s":
+            counts[value] += 1
+        elif kind == "S":
+            for x in value:
+                counts[x] += 1
+        elif kind == "o":
+            count_strings(value, counts)
+        elif kind == "O":
+            for x in value:
+                count_strings(x, counts)
+
+
+class CompactEncoder:
+    """Encode objects as `[shape, *values]` against shared tables.
+
+    A shape is an object's keys with the kind of each value, so keys are
+    stored once per shape instead of once per object; strings are indices
+    into the string table, times are minutes and empty arrays are left out.
+    """
+
+    def __init__(self, strings: list[str]):
+        self.index = {string: i for i, string in enumerate(strings)}
+        self.shapes: dict[tuple, int] = {}
+
+    def encode(self, obj: dict) -> list:
+        fields = tuple((key, compact_kind(value)) for key, value in obj.items())
+        encoded = [self.shapes.setdefault(fields, len(self.shapes))]
+        for (_, kind), value in zip(fields, obj.values()):
+            if kind == "s":
+                encoded.append(self.index[value])
+            elif kind == "t":
+                hours, minutes = value.split(":")
+                encoded.append(int(hours) * 60 + int(minutes))
+            elif kind in "ij":
+                encoded.append(value)
+            elif kind == "o":
+                encoded.append(self.encode(value))
+            elif kind == "S":
+                encoded.append([self.index[x] for x in value])
+            elif kind == "O":
+                encoded.append([self.encode(x) for x in value])
+        return encoded
+
+    def shape_table(self) -> list[list[str]]:
+        """Shapes in id order, each as a flat [key, kind, key, kind...]."""
+        return [[x for field in fields for x in field] for fields in self.shapes]
+
+
+def compact_items(doc: dict) -> Iterator[dict]:
+    """Reference decoder: rebuild the original items of a compact document,
+    one at a time."""
+    strings = doc["strings"]
+    shapes = [list(zip(shape[::2], shape[1::2])) for shape in doc["shapes"]]
+
+    def decode(encoded: list) -> dict:
+        obj = {}
+        values = iter(encoded[1:])
+        for key, kind in shapes[encoded[0]]:
+            if kind == "e":
+                obj[key] = []
+                continue
+            value = next(values)
+            if kind == "s":
+                value = strings[value]
+            elif kind == "t":
+                value = f"{value // 60:02d}:{value % 60:02d}"
+            elif kind == "o":
+                value = decode(value)
+            elif kind == "S":
+                value = [strings[x] for x in value]
+            elif kind == "O":
+                value = [decode(x) for x in value]
+            obj[key] = value
+        return obj
+
+    return (decode(item) for item in doc["items"])
+
+
+def compact_decode(doc: dict) -> list[dict]:
+    """Rebuild all the original items of a compact document."""
+    return list(compact_items(doc))
+
+
+def write_compact(path: Path, formats: list[str]) -> None:
+    """Write compact encodings of a JSON array file next to it.
+
+    `db.json` becomes `db.compact.json` and/or `db.msgpack`, both holding
+    `{"format", "version", "strings", "items", "shapes"}`. The string table
+    is ordered by frequency so common strings get small indices. Each file is
+    decoded again and checked against the original before it is kept.
+    """
+    counts: dict[str, int] = defaultdict(int)
+    num_items = 0
+    for item in iter_json_array(path):
+        count_strings(item, counts)
+        num_items += 1
+    strings = sorted(counts, key=lambda string: -counts[string])
+
+    for fmt in formats:
+        encoder = CompactEncoder(strings)
+        suffix = ".compact.json" if fmt == "json" else ".msgpack"
+        out = path.with_name(path.stem + suffix)
+        tmp = out.with_name("tmp-" + out.name)
+        header = {"format": "matrusp-compact", "version": 1, "strings": strings}
+        with open(tmp, "wb") as f:
+            if fmt == "json":
+                # The header object, left open for items and shapes
+                f.write(json.dumps(header, ensure_ascii=False)[:-1].encode())
+                f.write(b', "items": [')
+                for i, item in enumerate(iter_json_array(path)):
+                    if i:
+                        f.write(b",")
+                    data = json.dumps(encoder.encode(item), separators=(",", ":"))
+                    f.write(data.encode())
+                f.write(b'], "shapes": ')
+                f.write(json.dumps(encoder.shape_table(), ensure_ascii=False).encode())
+                f.write(b"}")
+            else:
+                import msgpack
+
+                packer = msgpack.Packer()
+                f.write(packer.pack_map_header(len(header) + 2))
+                for key, value in header.items():
+                    f.write(packer.pack(key) + packer.pack(value))
+                f.write(packer.pack("items") + packer.pack_array_header(num_items))
+                for item in iter_json_array(path):
+                    f.write(packer.pack(encoder.encode(item)))
+                f.write(packer.pack("shapes") + packer.pack(encoder.shape_table()))
+
+        # Item by item, so neither side is held decoded in full
+        doc = load_compact(tmp)
+        if len(doc["items"]) != num_items or any(
+            decoded != item
+            for decoded, item in zip(compact_items(doc), iter_json_array(path))
+        ):
+            tmp.unlink()
+            raise ValueError(f"{out.name} does not decode back to {path.name}")
+        tmp.replace(out)
+        console.print(
+            f"[green]Saved {out.name}: {out.stat().st_size:,} bytes "
+            f"({path.name}: {path.stat().st_size:,})[/green]"
+        )
+
+
+def load_compact(path: Path) -> dict:
+    """Load a .compact.json or .msgpack file, still encoded."""
+    if path.suffix == ".msgpack":
+        import msgpack
+
+        return msgpack.unpackb(path.read_bytes())
+    return json.loads(path.read_bytes())
+
+
+def read_compact(path: Path) -> list[dict]:
+    """Load and decode a .compact.json or .msgpack file."""
+    return compact_decode(load_compact(path))
+
+
+# ============================================
+# Split Output
+# ============================================
+
+SPLIT_MODES = ("campus", "unidade")
+
+
+def slugify(name: str) -> str:
+    """File name for a campus or unit: "São Carlos" -> "sao-carlos"."""
+    name = RE_COMBINING.sub("", unicodedata.normalize("NFD", name.lower()))
+    return re.sub(r"[^a-z0-9]+", "-", name).strip("-") or "outro"
+
+
+def split_outputs(output_dir: Path, modes: list[str]) -> None:
+    """Write db.json per campus and/or unit, and cursos.json per unit.
+
+    Files go under `split/` (`campus/<slug>.json`, `unidade/<slug>.json`,
+    `cursos/<slug>.json`), described by `split/index.json`: the campi.json
+    mapping plus, for each campus and unit, its files with item count, size
+    and sha256. Files left over from earlier runs are removed.
+    """
+    split_dir = output_dir / "split"
+    campi_path = output_dir / "campi.json"
+    campi = json.loads(campi_path.read_text()) if campi_path.exists() else {}
+    index: dict[str, dict] = {
+        "campi": {c: {"unidades": units} for c, units in campi.items()},
+        "unidades": {},
+    }
+
+    # (output file, kind of partition, item field)
+    plan = [("db.json", mode, mode) for mode in modes]
+    if "unidade" in modes:
+        plan.append(("cursos.json", "cursos", "unidade"))
+
+    written = set()
+    for name, kind, field in plan:
+        if not (output_dir / name).exists():
+            continue
+        writers: dict[str, JsonArrayWriter] = {}
+        with ExitStack() as stack:
+            for item in iter_json_array(output_dir / name):
+                key = item.get(field) or "Outro"
+                if key not in writers:
+                    path = split_dir / kind / f"{slugify(key)}.json"
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    writers[key] = stack.enter_context(JsonArrayWriter(path))
+                writers[key].write(item)
+                if kind == "unidade":
+                    entry = index["unidades"].setdefault(key, {})
+                    entry.setdefault("campus", item.get("campus"))
+
+        for key, writer in writers.items():
+            path = writer.path
+            written.add(path)
+            info = {
+                "file": path.relative_to(split_dir).as_posix(),
+                "count": writer.count,
+                "bytes": path.stat().st_size,
+                "sha256": file_sha256(path),
+            }
+            if kind == "campus":
+                index["campi"].setdefault(key, {})["lectures"] = info
+            else:
+                entry = index["unidades"].setdefault(key, {})
+                entry["lectures" if kind == "unidade" else "cursos"] = info
+
+    # Also drops precompressed copies of files that are gone
+    for path in split_dir.glob("*/*.json*"):
+        if path.with_name(path.name.partition(".json")[0] + ".json") not in written:
+            path.unlink()
+
+    tmp = split_dir / "index.json.tmp"
+    tmp.write_text(json.dumps(index, ensure_ascii=False, indent=2))
+    tmp.replace(split_dir / "index.json")
+    console.print(
+        f"[green]Split into {len(written)} files, indexed in split/index.json[/green]"
+    )
+
+
+# ============================================
+# Precompressed Output
+# ============================================
+
+PRECOMPRESS_FORMATS = ("gz", "br", "zst")
+
+
+def codec(fmt: str) -> tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    """(compress, decompress) at the highest-ratio settings for fmt."""
+    if fmt == "gz":
+        import gzip
+
+        return partial(gzip.compress, compresslevel=9, mtime=0), gzip.decompress
+    if fmt == "br":
+        import brotli
+
+        return partial(brotli.compress, quality=11, lgwin=24), brotli.decompress
+    import zstandard
+
+    return (
+        zstandard.ZstdCompressor(level=22).compress,
+        zstandard.ZstdDecompressor().decompress,
+    )
+
+
+def precompress(output_dir: Path, formats: list[str]) -> dict[str, dict[str, int]]:
+    """Write `<file>.<fmt>` next to each output file, for static hosting.
+
+    Covers OUTPUT_FILES, their compact encodings and the `split/` files.
+    A compressed file is only rewritten when it no longer decompresses to
+    its source, which is much cheaper than compressing again. Returns the
+    compressed sizes by file (relative to `output_dir`) and format.
+    """
+    paths = [output_dir / name for name in OUTPUT_FILES]
+    for key in ITEM_KEYS:
+        stem = Path(key).stem
+        paths += [output_dir / f"{stem}.compact.json", output_dir / f"{stem}.msgpack"]
+    paths += sorted((output_dir / "split").glob("**/*.json"))
+
+    sizes = {}
+    for path in paths:
+        if not path.exists():
+            continue
+        name = path.relative_to(output_dir).as_posix()
+        data = path.read_bytes()
+        sizes[name] = {"json": len(data)}
+        notes = []
+        for fmt in formats:
+            compress, decompress = codec(fmt)
+            out = path.with_name(f"{path.name}.{fmt}")
+            if out.exists() and decompress(out.read_bytes()) == data:
+                notes.append(f"{fmt} {out.stat().st_size:,} (unchanged)")
+            else:
+                tmp = out.with_name(out.name + ".tmp")
+                tmp.write_bytes(compress(data))
+                tmp.replace(out)
+                notes.append(f"{fmt} {out.stat().st_size:,}")
+            sizes[name][fmt] = out.stat().st_size
+        console.print(f"{name}: {len(data):,} bytes -> {', '.join(notes)}")
+    return sizes
+
+
+# ============================================
+# Scheduler
+# ============================================
+
+
+class Pipeline(NamedTuple):
+    """A listing stage feeding a fetch stage.
+
+    `list_items` turns each source (a unit code) into items, `fetch_item` turns
+    each item into a result or None, and `done` receives every result.
+    """
+
+    name: str
+    sources: list
+    list_items: Callable[[Any], Awaitable[list]]
+    fetch_item: Callable[[Any], Awaitable[Any]]
+    done: Callable[[Any], None]
+
+
+class Dedup:
+    """Registry collapsing repeated work within a run.
+
+    Items are claimed by key (a lecture codigo, a course link) as listings
+    arrive, so one listed under several units is fetched and written once.
+    Pages requested again while a fetch of them is in flight share its
+    future instead; they are forgotten once done, so results are not kept.
+    """
+
+    def __init__(self):
+        self.claimed: dict[str, set[str]] = defaultdict(set)  # pipeline -> keys
+        self.skipped: dict[str, int] = defaultdict(int)
+        self.in_flight: dict[str, asyncio.Future] = {}
+        self.shared = 0
+
+    def claim(self, pipeline: str, items: list[tuple]) -> list[tuple]:
+        """The items whose key (first element) was not claimed before."""
+        claimed = self.claimed[pipeline]
+        fresh = []
+        for item in items:
+            if item[0] in claimed:
+                self.skipped[pipeline] += 1
+            else:
+                claimed.add(item[0])
+                fresh.append(item)
+        return fresh
+
+    async def run(self, key: str, fn, *args):
+        """Await fn(*args), or the call already in flight for key."""
+        future = self.in_flight.get(key)
+        if future is None:
+            future = self.in_flight[key] = asyncio.ensure_future(fn(*args))
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.shared += 1
+        # A cancelled caller must not cancel the fetch the others wait for
+        return await asyncio.shield(future)
+
+    def summary(self) -> str:
+        skipped = ", ".join(
+            f"{count} repeated {pipeline}s" for pipeline, count in self.skipped.items()
+        )
+        return (
+            f"Dedup: skipped {skipped or 'no repeated items'}, "
+            f"{self.shared} page fetches shared while in flight"
+        )
+
+
+class Scheduler:
+    """Fixed pool of workers draining a bounded queue of fetch jobs.
+
+    Listings are throttled separately and enqueue their items as soon as they
+    arrive, so fetching starts with the first listing. The bounded queue makes
+    listings wait for the workers instead of piling up items in memory. All
+    state lives on the instance, so several schedulers can share a process.
+    """
+
+    def __init__(
+        self, concurrency: int, listing_concurrency: int = 8, queue_size: int = 0
+    ):
+        self.concurrency = concurrency
+        self.listing = asyncio.Semaphore(listing_concurrency)
+        self.jobs: asyncio.Queue = asyncio.Queue(queue_size or concurrency * 4)
+        # (pipeline, item or source) -> error
+        self.failed: dict[tuple[str, str], str] = {}
+
+    async def run(self, *pipelines: Pipeline) -> None:
+        """Run pipelines to completion, sharing the same workers."""
+        workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(
+                *(
+                    self._list(pipeline, source)
+                    for pipeline in pipelines
+                    for source in pipeline.sources
+                )
+            )
+            await self.jobs.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _list(self, pipeline: Pipeline, source) -> None:
+        try:
+            async with self.listing:
+                items = await pipeline.list_items(source)
+        except Exception as e:
+            # The other sources go on; --resume lists this one again
+            error = self.failed[pipeline.name, str(source)] = describe_error(e)
+            console.print(f"[red]Error listing {source}: {error}[/red]")
+            return
+        for item in items:
+            await self.jobs.put((pipeline, item))
+
+    async def _work(self) -> None:
+        while True:
+            pipeline, item = await self.jobs.get()
+            try:
+                result = await pipeline.fetch_item(item)
+                if result:
+                    pipeline.done(result)
+            except Exception as e:
+                key = item[0] if isinstance(item, tuple) else str(item)
+                error = self.failed[pipeline.name, key] = describe_error(e)
+                console.print(f"[red]Error fetching {key}: {error}[/red]")
+            finally:
+                self.jobs.task_done()
+
+    def report(self) -> None:
+        """List the items that still failed after all retries."""
+        if not self.failed:
+            return
+        console.print(f"[red bold]{len(self.failed)} items failed:[/red bold]")
+        for (name, key), error in sorted(self.failed.items()):
+            console.print(f"[red]  {name} {key}: {error}[/red]")
+
+
+# ============================================
+# Scraping Functions
+# ============================================
+
+
+class Fetcher:
+    """What the fetch_* functions need during one run.
+
+    Holds the client, the parser backend, the optional parse pool, page cache
+    and metadata store, and the run's dedup registry and unit codes, so runs
+    sharing a process do not share any of them.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        parser: str = "html5lib",
+        parse_pool: ProcessPoolExecutor | None = None,
+        page_cache: PageCache | None = None,
+        metadata: MetadataStore | None = None,
+    ):
+        self.client = client
+        self.parser = parser  # one of PARSERS
+        self.parse_pool = parse_pool  # None parses on the event loop
+        self.page_cache = page_cache  # None disables the on-disk cache
+        self.metadata = metadata  # None always fetches metadata
+        self.dedup = Dedup()
+        self.unit_codes: dict[str, str] = {}  # unit name -> code
+
+
+async def get(
+    client: httpx.AsyncClient,
+    url: str,
+    timeout: int,
+    headers: dict[str, str] | None = None,
+) -> httpx.Response:
+    """GET a page, raising on HTTP errors."""
+    resp = await client.get(url, timeout=timeout, headers=headers)
+    if resp.status_code != 304:
+        resp.raise_for_status()
+    return resp
+
+
+async def run_parser(parse_pool: ProcessPoolExecutor | None, fn, *args):
+    """Run a page parser in the parse pool, or inline when there is none."""
+    if parse_pool is None:
+        result, elapsed = timed(fn, *args)
+    else:
+        loop = asyncio.get_running_loop()
+        result, elapsed = await loop.run_in_executor(parse_pool, timed, fn, *args)
+    metrics.parses[fn.__name__].append(elapsed)
+    return result
+
+
+async def fetch_parsed(fetcher: Fetcher, url: str, timeout: int, fn, *args):
+    """Fetch a page and parse it with fn(text, *args), through the page cache.
+
+    Concurrent calls for the same page and parser share one fetch.
+    """
+    return await fetcher.dedup.run(
+        f"{fn.__name__} {url}", _fetch_parsed, fetcher, url, timeout, fn, *args
+    )
+
+
+async def _fetch_parsed(fetcher: Fetcher, url: str, timeout: int, fn, *args):
+    page_cache = fetcher.page_cache
+    if page_cache is None:
+        resp = await get(fetcher.client, url, timeout)
+        return await run_parser(fetcher.parse_pool, fn, resp.text, *args)
+
+    text, sha = await page_cache.fetch(fetcher.client, url, timeout)
+    key = page_cache.parsed_key(sha, fn, args)
+    result = page_cache.load_parsed(key)
+    if result is None:
+        result = await run_parser(fetcher.parse_pool, fn, text, *args)
+        page_cache.store_parsed(url, key, result)
+    return result
+
+
+async def fetch_units(fetcher: Fetcher) -> dict[str, str]:
+    """Fetch all teaching units.
+
+    Always fetched, even with a metadata store, so new or renamed units are
+    scraped in the same run; the page cache still avoids reparsing it.
+    """
+    url = "https://uspdigital.usp.br/jupiterweb/jupColegiadoLista?tipo=T"
+    return await fetch_parsed(fetcher, url, 60, parse_units_page, fetcher.parser)
+
+
+async def fetch_unit_lectures(
+    fetcher: Fetcher, unit_code: str
+) -> list[tuple[str, str]]:
+    """Fetch all lectures from a unit."""
+    url = f"https://uspdigital.usp.br/jupiterweb/jupDisciplinaLista?letra=A-Z&tipo=T&codcg={unit_code}"
+    return await fetch_parsed(
+        fetcher, url, 120, parse_unit_lectures_page, fetcher.parser
+    )
+
+
+async def fetch_lecture(
+    fetcher: Fetcher, codigo: str, nome: str, timeout: int
+) -> Lecture | None:
+    """Fetch and parse a single lecture.
+
+    Returns None for lectures without classrooms; network errors are raised.
+    """
+    # Fetch classrooms
+    url = f"https://uspdigital.usp.br/jupiterweb/obterTurma?print=true&sgldis={codigo}"
+    classrooms = await fetch_parsed(
+        fetcher, url, timeout, parse_turma_page, fetcher.parser
+    )
+
+    if not classrooms:
+        return None
+
+    # Fetch lecture info, unless the metadata store already has it
+    metadata = fetcher.metadata
+    info = metadata.get("disciplinas", codigo) if metadata else None
+    if info is None:
+        url = f"https://uspdigital.usp.br/jupiterweb/obterDisciplina?print=true&sgldis={codigo}"
+        info = await fetch_parsed(
+            fetcher,
+            url,
+            timeout,
+            parse_disciplina_page,
+            fetcher.parser,
+            fetcher.unit_codes,
+        )
+
+        if not info.get("codigo"):
+            return None
+
+        if metadata:
+            metadata.put("disciplinas", codigo, info)
+
+    return Lecture(info, classrooms)
+
+
+async def fetch_unit_courses(fetcher: Fetcher, unit_code: str) -> list[tuple[str, str]]:
+    """Fetch all courses from a unit."""
+    url = f"https://uspdigital.usp.br/jupiterweb/jupCursoLista?tipo=N&codcg={unit_code}"
+    return await fetch_parsed(
+        fetcher, url, 120, parse_unit_courses_page, fetcher.parser
+    )
+
+
+async def fetch_course(
+    fetcher: Fetcher,
+    link: str,
+    period: str,
+    timeout: int,
+) -> dict | None:
+    """Fetch and parse a single course. Network errors are raised."""
+    url = f"https://uspdigital.usp.br/jupiterweb/{link}"
+    return await fetch_parsed(
+        fetcher,
+        url,
+        timeout,
+        parse_course_page,
+        fetcher.parser,
+        link,
+        period,
+        fetcher.unit_codes,
+    )
+
+
+# ============================================
+# Main Functions
+# ============================================
+
+
+def in_shard(key: str, shard: tuple[int, int]) -> bool:
+    """Whether key (a lecture code or course link) belongs to shard i of N."""
+    index, count = shard
+    return zlib.crc32(key.encode()) % count == index - 1
+
+
+def lecture_pipeline(
+    fetcher: Fetcher,
+    units: list[str],
+    timeout: int,
+    progress: Progress,
+    writer: JsonArrayWriter,
+    journal: Journal | None = None,
+    shard: tuple[int, int] | None = None,
+) -> Pipeline:
+    """Pipeline listing each unit's lectures and fetching each of them.
+
+    Only lectures in `shard` are kept, each codigo once, and those already in
+    the journal are written from it instead of fetched.
+    """
+    units_task = progress.add_task("Lecture units", total=len(units))
+    lectures_task = progress.add_task("Lectures", total=0)
+    found = 0
+
+    async def list_unit(code: str) -> list[tuple[str, str]]:
+        nonlocal found
+        lectures = await fetch_unit_lectures(fetcher, code)
+        if shard:
+            lectures = [item for item in lectures if in_shard(item[0], shard)]
+        lectures = fetcher.dedup.claim("lecture", lectures)
+        if journal:
+            lectures = journal.pending("lecture", lectures, writer.write)
+        found += len(lectures)
+        progress.update(lectures_task, total=found)
+        progress.advance(units_task)
+        return lectures
+
+    async def fetch(item: tuple[str, str]) -> Lecture | None:
+        codigo, nome = item
+        try:
+            lecture = await fetch_lecture(fetcher, codigo, nome, timeout)
+            if journal:
+                journal.record("lecture", codigo, lecture)
+            return lecture
+        finally:
+            progress.advance(lectures_task)
+
+    return Pipeline("lecture", units, list_unit, fetch, writer.write)
+
+
+def course_pipeline(
+    fetcher: Fetcher,
+    units: list[str],
+    timeout: int,
+    progress: Progress,
+    writer: JsonArrayWriter,
+    journal: Journal | None = None,
+    shard: tuple[int, int] | None = None,
+) -> Pipeline:
+    """Pipeline listing each unit's courses and fetching each of them.
+
+    Only courses in `shard` are kept, each link once, and those already in the
+    journal are written from it instead of fetched.
+    """
+    units_task = progress.add_task("Course units", total=len(units))
+    courses_task = progress.add_task("Courses", total=0)
+    found = 0
+
+    async def list_unit(code: str) -> list[tuple[str, str]]:
+        nonlocal found
+        courses = await fetch_unit_courses(fetcher, code)
+        if shard:
+            courses = [item for item in courses if in_shard(item[0], shard)]
+        courses = fetcher.dedup.claim("course", courses)
+        if journal:
+            courses = journal.pending("course", courses, writer.write)
+        found += len(courses)
+        progress.update(courses_task, total=found)
+        progress.advance(units_task)
+        return courses
+
+    async def fetch(item: tuple[str, str]) -> dict | None:
+        link, period = item
+        try:
+            course = await fetch_course(fetcher, link, period, timeout)
+            if journal:
+                journal.record("course", link, course)
+            return course
+        finally:
+            progress.advance(courses_task)
+
+    return Pipeline("course", units, list_unit, fetch, writer.write)
+
+
+async def scrape(
+    output_dir: Path,
+    units: list[str] | None,
+    concurrency: int,
+    timeout: int,
+    transport: AdaptiveTransport,
+    parser: str = "html5lib",
+    sort: bool = False,
+    lectures: bool = True,
+    courses: bool = False,
+    journal: Journal | None = None,
+    shard: tuple[int, int] | None = None,
+    parse_pool: ProcessPoolExecutor | None = None,
+    page_cache: PageCache | None = None,
+    metadata: MetadataStore | None = None,
+):
+    """Scrape lectures (db.json, campi.json) and/or courses (cursos.json).
+
+    Units are fetched once, and both pipelines share one client and one
+    scheduler when run together. Every finished item is recorded in the
+    journal, which is cleared once a run ends with no failed items. With
+    `shard` (i, N), only that share of lectures and courses is scraped;
+    `merge` combines the shards' outputs. Lectures and courses listed under
+    several units are fetched once. The parse pool, page cache and metadata
+    store are optional and only used by this run's Fetcher.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    async with make_client(transport) as client:
+        fetcher = Fetcher(client, parser, parse_pool, page_cache, metadata)
+        dedup = fetcher.dedup
+
+        # Fetch units
+        console.print("[bold]Fetching teaching units...[/bold]")
+        with metrics.stage("units"):
+            unit_codes = fetcher.unit_codes = await fetch_units(fetcher)
+        console.print(f"Found {len(unit_codes)} units")
+
+        if lectures:
+            # Save campi.json
+            campi: dict[str, list[str]] = {}
+            for unit_name, code in unit_codes.items():
+                campus = CAMPUS_BY_UNIT.get(int(code), "Outro")
+                if campus not in campi:
+                    campi[campus] = []
+                campi[campus].append(unit_name)
+
+            (output_dir / "campi.json").write_text(
+                json.dumps(campi, ensure_ascii=False)
+            )
+
+        # Filter units if specified
+        target_units = units or list(unit_codes.values())
+        if units:
+            console.print(f"Filtering to {len(units)} units: {units}")
+
+        # List each unit, fetching every lecture/course as soon as it is listed
+        # and streaming it to its output file as soon as it is parsed
+        console.print("[bold]Fetching unit listings and pages...[/bold]")
+        sort_key = "codigo" if sort else None
+        writers = {}
+        if lectures:
+            writers["db.json"] = JsonArrayWriter(output_dir / "db.json", sort_key)
+        if courses:
+            writers["cursos.json"] = JsonArrayWriter(
+                output_dir / "cursos.json", sort_key
+            )
+
+        scheduler = Scheduler(concurrency)
+        with Progress() as progress, ExitStack() as stack:
+            for writer in writers.values():
+                stack.enter_context(writer)
+            pipelines = []
+            if lectures:
+                pipelines.append(
+                    lecture_pipeline(
+                        fetcher,
+                        target_units,
+                        timeout,
+                        progress,
+                        writers["db.json"],
+                        journal,
+                        shard,
+                    )
+                )
+            if courses:
+                pipelines.append(
+                    course_pipeline(
+                        fetcher,
+                        target_units,
+                        timeout,
+                        progress,
+                        writers["cursos.json"],
+                        journal,
+                        shard,
+                    )
+                )
+            with metrics.stage("pages"):
+                await scheduler.run(*pipelines)
+
+        for name, writer in writers.items():
+            console.print(f"[green]Saved {writer.count} items to {name}[/green]")
+        if journal:
+            if journal.resumed:
+                console.print(f"Resumed {journal.resumed} items from {journal.path}")
+            metrics.extra["resumed"] = journal.resumed
+            if not scheduler.failed:
+                journal.clear()
+        console.print(transport.summary())
+        console.print(dedup.summary())
+        metrics.extra["dedup"] = {
+            "skipped": dict(dedup.skipped),
+            "shared_fetches": dedup.shared,
+        }
+        scheduler.report()
+        metrics.extra["failed"] = {
+            f"{name} {key}": error for (name, key), error in scheduler.failed.items()
+        }
+        metrics.extra["concurrency"] = {
+            "final": int(transport.limiter.limit),
+            "peak": int(transport.limiter.peak),
+            "decreases": transport.limiter.decreases,
+            "gave_up": transport.stats["gave_up"],
+        }
+
+
+async def scrape_vacancies(
+    output_dir: Path,
+    units: list[str] | None,
+    concurrency: int,
+    timeout: int,
+    transport: AdaptiveTransport,
+    parser: str = "html5lib",
+    sort: bool = False,
+    shard: tuple[int, int] | None = None,
+    parse_pool: ProcessPoolExecutor | None = None,
+    page_cache: PageCache | None = None,
+) -> set[str]:
+    """Refresh vagas.json from obterTurma alone, for the lectures in db.json.
+
+    vagas.json maps lecture codigo -> turma codigo -> vacancies, in db.json's
+    order (codigo order with `sort`). Lectures now without classrooms are
+    left out. Returns the codigos whose obterTurma page was read, which the
+    vacancy history may mark as removed.
+    """
+    lectures = [
+        (lecture["codigo"], lecture.get("unidade"))
+        for lecture in iter_json_array(output_dir / "db.json")
+    ]
+    if shard:
+        lectures = [item for item in lectures if in_shard(item[0], shard)]
+    codigos = list(dict.fromkeys(codigo for codigo, _ in lectures))
+    results: dict[str, dict] = {}
+
+    async with make_client(transport) as client:
+        fetcher = Fetcher(client, parser, parse_pool, page_cache)
+        if units:
+            unit_codes = await fetch_units(fetcher)
+            names = {name for name, code in unit_codes.items() if code in units}
+            selected = {codigo for codigo, unidade in lectures if unidade in names}
+            codigos = [codigo for codigo in codigos if codigo in selected]
+            console.print(f"Filtering to {len(units)} units: {units}")
+        console.print(f"[bold]Fetching vacancies of {len(codigos)} lectures...[/bold]")
+
+        scheduler = Scheduler(concurrency)
+        with Progress() as progress:
+            task = progress.add_task("Vacancies", total=len(codigos))
+
+            async def list_codigos(codigos: list[str]) -> list[tuple[str]]:
+                return [(codigo,) for codigo in codigos]
+
+            async def fetch(item: tuple[str]) -> tuple[str, dict] | None:
+                (codigo,) = item
+                url = f"https://uspdigital.usp.br/jupiterweb/obterTurma?print=true&sgldis={codigo}"
+                try:
+                    classrooms = await fetch_parsed(
+                        fetcher, url, timeout, parse_turma_vacancies_page, parser
+                    )
+                    return (codigo, classrooms) if classrooms else None
+                finally:
+                    progress.advance(task)
+
+            pipeline = Pipeline(
+                "vacancy", [codigos], list_codigos, fetch, lambda r: results.update([r])
+            )
+            with metrics.stage("pages"):
+                await scheduler.run(pipeline)
+
+        order = sorted(results) if sort else codigos
+        vagas = {codigo: results[codigo] for codigo in order if codigo in results}
+        path = output_dir / "vagas.json"
+        tmp = path.with_name(path.name + ".tmp")
+        with metrics.stage("write_output"):
+            tmp.write_text(json.dumps(vagas, ensure_ascii=False, default=json_default))
+            tmp.replace(path)
+        console.print(
+            f"[green]Saved vacancies of {len(vagas)} lectures to {path.name}[/green]"
+        )
+
+        console.print(transport.summary())
+        scheduler.report()
+        metrics.extra["failed"] = {
+            f"{name} {key}": error for (name, key), error in scheduler.failed.items()
+        }
+        return set(codigos) - {key for _, key in scheduler.failed}
+
+
+def merge(output_dir: Path, shard_dirs: list[Path], sort: bool = False) -> None:
+    """Combine the outputs of sharded runs into output_dir.
+
+    Lectures listed under several units are kept once per codigo, courses
+    once per codigo and periodo. campi.json is taken from the first shard.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for shard_dir in shard_dirs:
+        if (shard_dir / "campi.json").exists():
+            (output_dir / "campi.json").write_bytes(
+                (shard_dir / "campi.json").read_bytes()
+            )
+            break
+
+    for name, fields in ITEM_KEYS.items():
+        sources = [d / name for d in shard_dirs if (d / name).exists()]
+        if not sources:
+            continue
+        seen = set()
+        duplicates = 0
+        with JsonArrayWriter(output_dir / name, "codigo" if sort else None) as writer:
+            for source in sources:
+                for item in iter_json_array(source):
+                    key = item_key(item, fields)
+                    if key in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(key)
+                    writer.write(item)
+        console.print(
+            f"[green]Merged {len(sources)} shards into {writer.count} items "
+            f"in {name} ({duplicates} duplicates dropped)[/green]"
+        )
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parse an `i/N` shard spec, with 1 <= i <= N."""
+    import argparse
+
+    try:
+        index, count = map(int, value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {index} is not in 1..{count}")
+    return index, count
+
+
+DELTA_HELP = (
+    "Compare with the previous output and write manifest.json plus a delta "
+    "of added/changed/removed items"
+)
+
+SEARCH_HELP = "Precompute the client's search index from db.json into search.json"
+SCHEDULE_HELP = (
+    "Precompute turma time slots in minutes, weekly slot masks and per-lecture "
+    "conflicts from db.json into horarios.json"
+)
+REQUIREMENTS_HELP = (
+    "Build the requirement graph of all curricula in cursos.json into "
+    "requisitos.json: adjacency both ways, layers and transitive requirements"
+)
+COMPACT_HELP = (
+    "Also write db.json/cursos.json in compact encodings "
+    "(msgpack needs the 'compact' extra)"
+)
+SPLIT_HELP = (
+    "Also write lectures per campus and/or unit, and courses per unit, "
+    "under OUTPUT_DIR/split"
+)
+HISTORY_HELP = (
+    "Append this run's vacancies and schedules to an SQLite time series at "
+    "this path, and report what changed since the last run recorded there; "
+    "runs limited to some units or shards, or where a lecture failed, are "
+    "not recorded"
+)
+PRECOMPRESS_HELP = (
+    "Also write compressed copies of the outputs for static hosting "
+    "(br and zst need the 'compress' extra)"
+)
+
+
+def step_summary(markdown: str) -> None:
+    """Append to the GitHub Actions step summary, when there is one."""
+    if summary := os.environ.get("GITHUB_STEP_SUMMARY"):
+        with open(summary, "a") as f:
+            f.write(markdown)
+
+
+def check_codecs(parser, *chosen: list[str]) -> None:
+    """Exit with a usage error if a chosen encoding is not installed."""
+    modules = {"msgpack": "msgpack", "br": "brotli", "zst": "zstandard"}
+    extras = {"msgpack": "compact", "br": "compress", "zst": "compress"}
+    for fmt in (fmt for formats in chosen for fmt in formats):
+        if fmt not in modules:
+            continue
+        try:
+            __import__(modules[fmt])
+        except ImportError:
+            parser.error(f"{fmt} needs {modules[fmt]} (uv sync --extra {extras[fmt]})")
+
+
+def write_compact_outputs(output_dir: Path, formats: list[str]) -> None:
+    for name in ITEM_KEYS:
+        if (output_dir / name).exists():
+            write_compact(output_dir / name, formats)
+
+
+def merge_main(argv: list[str]) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="main.py merge", description="Merge the outputs of sharded scrapes"
+    )
+    parser.add_argument("output_dir", type=Path, help="Output directory for JSON files")
+    parser.add_argument("shard_dirs", type=Path, nargs="+", help="Shard outputs")
+    parser.add_argument(
+        "--sort", action="store_true", help="Write items in codigo order"
+    )
+    parser.add_argument("--delta", action="store_true", help=DELTA_HELP)
+    parser.add_argument("--history", type=Path, help=HISTORY_HELP)
+    parser.add_argument("--search-index", action="store_true", help=SEARCH_HELP)
+    parser.add_argument("--schedule-index", action="store_true", help=SCHEDULE_HELP)
+    parser.add_argument(
+        "--requirements-index", action="store_true", help=REQUIREMENTS_HELP
+    )
+    parser.add_argument(
+        "--compact", nargs="+", choices=COMPACT_FORMATS, default=[], help=COMPACT_HELP
+    )
+    parser.add_argument(
+        "--split", nargs="+", choices=SPLIT_MODES, default=[], help=SPLIT_HELP
+    )
+    parser.add_argument(
+        "--precompress",
+        nargs="+",
+        choices=PRECOMPRESS_FORMATS,
+        default=[],
+        help=PRECOMPRESS_HELP,
+    )
+    args = parser.parse_args(argv)
+    check_codecs(parser, args.compact, args.precompress)
+    manifest = Manifest(args.output_dir) if args.delta else None
+    merge(args.output_dir, args.shard_dirs, args.sort)
+    if args.search_index:
+        write_search_index(args.output_dir / "db.json", args.output_dir / "search.json")
+    if args.schedule_index:
+        write_schedule_index(
+            args.output_dir / "db.json", args.output_dir / "horarios.json"
+        )
+    if args.requirements_index and (args.output_dir / "cursos.json").exists():
+        write_requirements_index(
+            args.output_dir / "cursos.json", args.output_dir / "requisitos.json"
+        )
+    write_compact_outputs(args.output_dir, args.compact)
+    if args.split:
+        split_outputs(args.output_dir, args.split)
+    if args.precompress:
+        precompress(args.output_dir, args.precompress)
+    if manifest:
+        manifest.update()
+    if args.history and (args.output_dir / "db.json").exists():
+        runs = []
+        for shard_dir in args.shard_dirs:
+            path = shard_dir / "metrics.json"
+            runs.append(json.loads(path.read_text()) if path.exists() else None)
+        if None in runs:
+            reason = "a shard has no metrics.json"
+        else:
+            reason = history_skip_reason(runs)
+        if reason:
+            console.print(f"[yellow]History: not recorded, {reason}[/yellow]")
+        else:
+            record_history(args.history, iter_json_array(args.output_dir / "db.json"))
+
+
+def main():
+    import argparse
+
+    if sys.argv[1:2] == ["merge"]:
+        return merge_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description="MatrUSP JupiterWeb Scraper")
+    parser.add_argument("output_dir", type=Path, help="Output directory for JSON files")
+    parser.add_argument(
+        "--units", "-u", nargs="+", help="Specific unit codes to scrape"
+    )
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        type=int,
+        default=50,
+        help="Max concurrent requests (adapts below this to JupiterWeb's load)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=4,
+        help="Retries per request on timeouts, 429 and 5xx, with backoff",
+    )
+    parser.add_argument(
+        "--timeout", "-t", type=int, default=60, help="Request timeout in seconds"
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--cursos", action="store_true", help="Scrape courses instead of lectures"
+    )
+    mode.add_argument(
+        "--all",
+        action="store_true",
+        help="Scrape lectures and courses in one pass, sharing units and client",
+    )
+    mode.add_argument(
+        "--vacancies-only",
+        action="store_true",
+        help="Only refresh vacancies into vagas.json, for the lectures in "
+        "OUTPUT_DIR/db.json (one obterTurma request per lecture)",
+    )
+    parser.add_argument(
+        "--parser",
+        choices=PARSERS,
+        default="html5lib",
+        help="HTML parsing backend (lxml and selectolax need the 'fast' extra)",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=0,
+        help="Parse pages in this many processes (0 parses on the event loop)",
+    )
+    parser.add_argument(
+        "--sort",
+        action="store_true",
+        help="Write lectures and courses in codigo order (stable git diffs)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="Where to write run metrics (default: OUTPUT_DIR/metrics.json)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        help="Profile the run into this file: cProfile stats, or a pyinstrument "
+        "HTML report if it ends in .html (main process only)",
+    )
+    parser.add_argument(
+        "--record", type=Path, help="Save every response in this directory"
+    )
+    parser.add_argument(
+        "--replay",
+        type=Path,
+        help="Serve responses saved with --record instead of using the network",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        type=float,
+        default=0,
+        help="Artificial latency per replayed request, in milliseconds",
+    )
+    parser.add_argument(
+        "--cache-dir", type=Path, help="Keep pages and parse results here between runs"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=1024, help="Cache size cap in MB"
+    )
+    parser.add_argument(
+        "--metadata",
+        type=Path,
+        help="Discipline metadata store (default: CACHE_DIR/metadata.json)",
+    )
+    parser.add_argument(
+        "--metadata-ttl",
+        type=float,
+        default=90,
+        help="Days before stored metadata is fetched again",
+    )
+    parser.add_argument(
+        "--refresh-metadata",
+        action="store_true",
+        help="Fetch all metadata again, ignoring the store",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        help="Checkpoint journal of finished items (default: "
+        "CACHE_DIR/journal.jsonl; none without --cache-dir)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip items already in the journal, merging them into the output",
+    )
+    parser.add_argument("--delta", action="store_true", help=DELTA_HELP)
+    parser.add_argument("--history", type=Path, help=HISTORY_HELP)
+    parser.add_argument("--search-index", action="store_true", help=SEARCH_HELP)
+    parser.add_argument("--schedule-index", action="store_true", help=SCHEDULE_HELP)
+    parser.add_argument(
+        "--requirements-index", action="store_true", help=REQUIREMENTS_HELP
+    )
+    parser.add_argument(
+        "--compact", nargs="+", choices=COMPACT_FORMATS, default=[], help=COMPACT_HELP
+    )
+    parser.add_argument(
+        "--split", nargs="+", choices=SPLIT_MODES, default=[], help=SPLIT_HELP
+    )
+    parser.add_argument(
+        "--precompress",
+        nargs="+",
+        choices=PRECOMPRESS_FORMATS,
+        default=[],
+        help=PRECOMPRESS_HELP,
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Scrape only shard i of N (e.g. 2/4) of lectures and courses; "
+        "combine the outputs with `main.py merge`",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        parse_html("", args.parser)
+    except (ImportError, FeatureNotFound):
+        parser.error(f"--parser {args.parser} is not installed (uv sync --extra fast)")
+    check_codecs(parser, args.compact, args.precompress)
+    if args.vacancies_only and not (args.output_dir / "db.json").exists():
+        parser.error("--vacancies-only needs a previous db.json in OUTPUT_DIR")
+    if args.resume and not (args.journal or args.cache_dir):
+        parser.error("--resume needs --cache-dir or --journal")
+
+    parse_pool = page_cache = metadata = None
+    # Read back by `merge` to tell whether shards add up to a full run
+    metrics.extra["scope"] = {"units": args.units, "shard": args.shard}
+    if args.parse_workers > 0:
+        parse_pool = ProcessPoolExecutor(args.parse_workers)
+    if args.cache_dir:
+        page_cache = PageCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    if metadata_path := args.metadata or (
+        args.cache_dir and args.cache_dir / "metadata.json"
+    ):
+        metadata = MetadataStore(
+            metadata_path, args.metadata_ttl * 86400, args.refresh_metadata
+        )
+
+    # A vacancy refresh is cheap to redo, and must not touch a full run's
+    # journal. It is never kept in OUTPUT_DIR, where it would be published.
+    journal = None
+    journal_path = args.journal or (args.cache_dir and args.cache_dir / "journal.jsonl")
+    if journal_path and not args.vacancies_only:
+        journal = Journal(journal_path, args.resume)
+
+    manifest = Manifest(args.output_dir) if args.delta else None
+
+    start = time.perf_counter()
+
+    try:
+        transport = make_transport(
+            args.concurrency,
+            args.retries,
+            args.record,
+            args.replay,
+            args.replay_latency / 1000,
+        )
+        with profiled(args.profile):
+            if args.vacancies_only:
+                run = scrape_vacancies(
+                    args.output_dir,
+                    args.units,
+                    args.concurrency,
+                    args.timeout,
+                    transport,
+                    args.parser,
+                    args.sort,
+                    args.shard,
+                    parse_pool,
+                    page_cache,
+                )
+            else:
+                run = scrape(
+                    args.output_dir,
+                    args.units,
+                    args.concurrency,
+                    args.timeout,
+                    transport,
+                    args.parser,
+                    args.sort,
+                    lectures=not args.cursos,
+                    courses=args.cursos or args.all,
+                    journal=journal,
+                    shard=args.shard,
+                    parse_pool=parse_pool,
+                    page_cache=page_cache,
+                    metadata=metadata,
+                )
+            covered = asyncio.run(run)
+    finally:
+        if journal:
+            journal.close()
+        if parse_pool:
+            parse_pool.shutdown(cancel_futures=True)
+        if page_cache:
+            page_cache.save()
+        if metadata:
+            metadata.save()
+
+    if args.search_index and not (args.cursos or args.vacancies_only):
+        with metrics.stage("search_index"):
+            write_search_index(
+                args.output_dir / "db.json", args.output_dir / "search.json"
+            )
+    if args.schedule_index and not (args.cursos or args.vacancies_only):
+        with metrics.stage("schedule_index"):
+            write_schedule_index(
+                args.output_dir / "db.json", args.output_dir / "horarios.json"
+            )
+    if args.requirements_index and (args.cursos or args.all):
+        with metrics.stage("requirements_index"):
+            write_requirements_index(
+                args.output_dir / "cursos.json", args.output_dir / "requisitos.json"
+            )
+    if args.compact:
+        with metrics.stage("compact"):
+            write_compact_outputs(args.output_dir, args.compact)
+    if args.split:
+        with metrics.stage("split"):
+            split_outputs(args.output_dir, args.split)
+    if args.precompress:
+        with metrics.stage("precompress"):
+            metrics.extra["compressed"] = precompress(args.output_dir, args.precompress)
+    if manifest:
+        with metrics.stage("delta"):
+            manifest.update()
+    if args.history and not args.cursos:
+        report = None
+        # A vacancy refresh only touches the lectures it read, so it is
+        # always recorded, limited to those
+        reason = None if args.vacancies_only else history_skip_reason([metrics.extra])
+        if reason:
+            console.print(f"[yellow]History: not recorded, {reason}[/yellow]")
+        elif args.vacancies_only:
+            vagas = json.loads((args.output_dir / "vagas.json").read_text())
+            lectures = (
+                {
+                    "codigo": codigo,
+                    "turmas": [
+                        {"codigo": turma, "vagas": vacancies}
+                        for turma, vacancies in turmas.items()
+                    ],
+                }
+                for codigo, turmas in vagas.items()
+            )
+            with metrics.stage("history"):
+                report = record_history(
+                    args.history, lectures, with_schedules=False, covered=covered
+                )
+        else:
+            with metrics.stage("history"):
+                report = record_history(
+                    args.history, iter_json_array(args.output_dir / "db.json")
+                )
+        if report:
+            metrics.extra["history"] = {
+                "lectures_added": len(report.lectures_added),
+                "lectures_removed": len(report.lectures_removed),
+                "schedules_changed": len(report.schedules_changed),
+                "vacancies_changed": len(report.vacancies_changed),
+            }
+
     elapsed = time.perf_counter() - start
+    metrics.stages["total"] = elapsed
+    metrics.extra["parse_workers"] = args.parse_workers
+    if page_cache:
+        metrics.extra["cache"] = page_cache.stats
+        console.print(page_cache.summary())
+    if metadata:
+        metrics.extra["metadata"] = metadata.stats
+        console.print(metadata.summary())
+
+    metrics.print()
+    metrics_path = args.metrics or args.output_dir / "metrics.json"
+    metrics_path.write_text(json.dumps(metrics.to_dict(), indent=2))
+    step_summary(metrics.markdown())
+
     console.print(f"[bold]Done in {elapsed:.1f}s[/bold]")
 
 